@@ -0,0 +1,571 @@
+import datetime
+from dateutil.parser import isoparse
+from redis_conn import r
+
+# the version of the calEvent:* and worklog:* hash layout written by encode_event and encode_worklog.
+# Hashes without a `v` field were written before it and are converted by `python3 maintenance.py migrate`
+schema_version = 2
+
+# the format the start of an event is handed out in, which is also what jira expects for `started`
+start_format = '%Y-%m-%dT%H:%M:%S.%f%z'
+
+# fields of an event that aren't stored but derived when it's loaded, and the stored fields they're derived from
+derived_fields = {
+    'event_id': [],
+    'event_type': [],
+    'start': ['start', 'offset'],
+    'start_str': ['start', 'offset'],
+    'end': ['end', 'offset'],
+}
+
+# the fields events stored before the schema was versioned have that encode_event no longer writes
+legacy_fields = ['event_id', 'start_str', 'event_type']
+
+# turns a stored `day` (YYYYMMDD) into the YYYY-MM-DD key of the daily totals. Events stored before the
+# schema was versioned have no `day` but an ISO `start` that begins with it
+event_day = """
+local function event_day(day, start)
+    if day then
+        return string.sub(day, 1, 4) .. '-' .. string.sub(day, 5, 6) .. '-' .. string.sub(day, 7, 8)
+    end
+    if start then
+        return string.sub(start, 1, 10)
+    end
+end
+"""
+
+# adds (sign 1) or removes (sign -1) an event's duration to the daily total of the day it starts on.
+# The totals are only kept up to date once they exist, see rebuild_daily_seconds_script
+adjust_daily_seconds = event_day + """
+local function adjust_daily_seconds(daily_key, event, sign)
+    local day = event_day(event[1], event[2])
+    if not day or not event[3] or redis.call('EXISTS', daily_key) == 0 then
+        return
+    end
+    if redis.call('HINCRBY', daily_key, day, sign * math.floor(tonumber(event[3]))) <= 0 then
+        redis.call('HDEL', daily_key, day)
+    end
+end
+"""
+
+# sets fields of a calendar event, moves its duration between daily totals if the start or duration changed
+# and files it under its day in the user's date index (KEYS[3], if given) in the same step, so the event is never
+# stored without being indexed. The fields of the old layout and the offset are cleared first, ARGV always holds the
+# whole encoded event
+update_event_script = r.register_script(adjust_daily_seconds + """
+local old = redis.call('HMGET', KEYS[1], 'day', 'start', 'duration')
+redis.call('HDEL', KEYS[1], 'event_id', 'start_str', 'event_type', 'offset')
+redis.call('HSET', KEYS[1], unpack(ARGV))
+local new = redis.call('HMGET', KEYS[1], 'day', 'start', 'duration')
+adjust_daily_seconds(KEYS[2], old, -1)
+adjust_daily_seconds(KEYS[2], new, 1)
+if KEYS[3] and new[1] then
+    redis.call('ZADD', KEYS[3], new[1], string.sub(KEYS[1], string.len('calEvent:') + 1))
+end
+""")
+
+# deletes a calendar event, the worklog linked to it and its date index entry
+delete_event_script = r.register_script(adjust_daily_seconds + """
+local event = redis.call('HMGET', KEYS[1], 'day', 'start', 'duration', 'jira_worklog_id')
+if event[4] then
+    redis.call('DEL', 'worklog:' .. event[4])
+end
+adjust_daily_seconds(KEYS[3], event, -1)
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+return event[4]
+""")
+
+# deletes a worklog, the calendar event it was logged for and the event's date index entry
+delete_worklog_script = r.register_script(adjust_daily_seconds + """
+local event_id = redis.call('HGET', KEYS[1], 'event_id')
+if event_id then
+    local event = redis.call('HMGET', 'calEvent:' .. event_id, 'day', 'start', 'duration')
+    adjust_daily_seconds(KEYS[3], event, -1)
+    redis.call('DEL', 'calEvent:' .. event_id)
+    redis.call('ZREM', KEYS[2], event_id)
+end
+redis.call('DEL', KEYS[1])
+return event_id
+""")
+
+# deletes a calendar event that is past its retention like delete_event_script, or only its date index entry if the event
+# itself is already gone. Events with a worklog are kept until ARGV[3] (YYYYMMDD), those without until ARGV[2].
+# Returns 'expired', 'dangling' or nothing if the event is kept
+expire_event_script = r.register_script(adjust_daily_seconds + """
+local day = tonumber(redis.call('ZSCORE', KEYS[2], ARGV[1]))
+if not day then
+    return false
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return 'dangling'
+end
+local event = redis.call('HMGET', KEYS[1], 'day', 'start', 'duration', 'jira_worklog_id')
+if day >= tonumber(ARGV[2]) or (event[4] and day >= tonumber(ARGV[3])) then
+    return false
+end
+if event[4] then
+    redis.call('DEL', 'worklog:' .. event[4])
+end
+adjust_daily_seconds(KEYS[3], event, -1)
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+return 'expired'
+""")
+
+# deletes a calendar event that isn't in its user's date index, and its worklog. The user's daily totals are dropped
+# rather than adjusted, since the event may not have been counted in them, and rebuilt from the index when next read
+delete_orphan_event_script = r.register_script("""
+local event = redis.call('HMGET', KEYS[1], 'user_id', 'jira_worklog_id')
+if event[1] and redis.call('ZSCORE', 'user:' .. event[1] .. ':calEvents', ARGV[1]) then
+    return 0
+end
+if event[2] then
+    redis.call('DEL', 'worklog:' .. event[2])
+end
+if event[1] then
+    redis.call('DEL', 'user:' .. event[1] .. ':daily_seconds')
+end
+return redis.call('DEL', KEYS[1])
+""")
+
+# deletes a worklog whose calendar event is gone
+delete_orphan_worklog_script = r.register_script("""
+local event_id = redis.call('HGET', KEYS[1], 'event_id')
+if event_id and redis.call('EXISTS', 'calEvent:' .. event_id) == 1 then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+""")
+
+# recomputes a user's daily totals from all of their stored events
+rebuild_daily_seconds_script = r.register_script(event_day + """
+local totals = {}
+for _, event_id in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    local event = redis.call('HMGET', 'calEvent:' .. event_id, 'day', 'start', 'duration')
+    local day = event_day(event[1], event[2])
+    if day and event[3] then
+        totals[day] = (totals[day] or 0) + math.floor(tonumber(event[3]))
+    end
+end
+redis.call('DEL', KEYS[2])
+local days = 0
+for day, seconds in pairs(totals) do
+    if seconds > 0 then
+        redis.call('HSET', KEYS[2], day, seconds)
+        days = days + 1
+    end
+end
+return days
+""")
+
+
+def to_timestamp(value) -> tuple:
+    """
+    Splits a date into epoch seconds and its UTC offset.
+
+    Args:
+        value: The date as a datetime or an ISO 8601 string, like jira's `2024-01-31T09:00:00.000-0600`.
+
+    Returns:
+        tuple: The epoch seconds and the UTC offset in minutes, or None for dates without a timezone.
+        Those are counted as UTC.
+    """
+    date = value if isinstance(value, datetime.datetime) else isoparse(str(value))
+
+    if date.tzinfo is None:
+        return int(date.replace(tzinfo=datetime.timezone.utc).timestamp()), None
+
+    return int(date.timestamp()), int(date.utcoffset().total_seconds() // 60)
+
+def from_timestamp(seconds: int, offset: int = None) -> datetime.datetime:
+    """
+    Turns epoch seconds and a UTC offset back into a date, see to_timestamp.
+
+    Args:
+        seconds (int): The epoch seconds.
+        offset (int, optional): The UTC offset in minutes. Defaults to a date without a timezone.
+
+    Returns:
+        datetime.datetime: The date.
+    """
+    if offset is None:
+        return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).replace(tzinfo=None)
+
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone(datetime.timedelta(minutes=offset)))
+
+def encode_event(event: dict) -> dict:
+    """
+    Converts a calendar event into the fields stored in its `calEvent:*` hash.
+
+    Dates are stored as epoch seconds with one UTC offset for the event, and the day it starts on
+    as YYYYMMDD. Fields that can be derived when the event is loaded aren't stored, see decode_event.
+
+    Args:
+        event (dict): The event. It needs a `start` and a `duration`.
+
+    Returns:
+        dict: The fields to store.
+    """
+    fields = {key: value for key, value in event.items() if value is not None and key not in derived_fields and key not in ('v', 'offset', 'day')}
+
+    start, offset = to_timestamp(event['start'])
+
+    fields['v'] = schema_version
+    fields['start'] = start
+    fields['day'] = from_timestamp(start, offset).strftime('%Y%m%d')
+    fields['duration'] = int(event['duration'])
+
+    if offset is not None:
+        fields['offset'] = offset
+    if event.get('end'):
+        fields['end'] = to_timestamp(event['end'])[0]
+
+    return fields
+
+def decode_event(event_id: str, fields: dict) -> dict:
+    """
+    Converts the fields stored in a `calEvent:*` hash back into the calendar event, see encode_event.
+
+    Events stored before the schema was versioned are returned as they were stored, apart from
+    the duration.
+
+    Args:
+        event_id (str): The ID of the event.
+        fields (dict): The stored fields. Missing fields may be None.
+
+    Returns:
+        dict: The event, or an empty dict if nothing is stored for it.
+    """
+    if all(value is None for value in fields.values()):
+        return {}
+
+    event = {key: value for key, value in fields.items() if value is not None and key not in ('v', 'offset', 'day')}
+    event['event_id'] = event_id
+    event['event_type'] = 'calendar'
+
+    if 'duration' in event:
+        event['duration'] = int(event['duration'])
+
+    if fields.get('v') is None:
+        return event
+
+    offset = int(fields['offset']) if fields.get('offset') is not None else None
+
+    # only all day events have dates without a timezone, google gives those as plain dates
+    def to_iso(date):
+        return date.isoformat() if offset is not None else date.date().isoformat()
+
+    if 'start' in event:
+        start = from_timestamp(int(event['start']), offset)
+        event['start'] = start.strftime(start_format)
+        event['start_str'] = to_iso(start)
+    if 'end' in event:
+        event['end'] = to_iso(from_timestamp(int(event['end']), offset))
+
+    return event
+
+def encode_worklog(worklog: dict, event_id: str) -> dict:
+    """
+    Converts a worklog jira returned into the fields stored in its `worklog:*` hash.
+
+    Args:
+        worklog (dict): The worklog as returned by jira.
+        event_id (str): The ID of the calendar event the worklog was logged for.
+
+    Returns:
+        dict: The fields to store.
+    """
+    fields = {
+        'v': schema_version,
+        'issue_id': worklog['issueId'],
+        'started': to_timestamp(worklog['started'])[0],
+        'seconds': int(worklog['timeSpentSeconds']),
+        'updated': to_timestamp(worklog['updated'])[0],
+    }
+
+    if event_id:
+        fields['event_id'] = event_id
+
+    return fields
+
+def save_worklog(worklog_id: str, worklog: dict, event_id: str) -> None:
+    """
+    Stores a worklog jira returned, replacing what was stored for it before.
+
+    Args:
+        worklog_id (str): The ID of the worklog.
+        worklog (dict): The worklog as returned by jira.
+        event_id (str): The ID of the calendar event the worklog was logged for.
+
+    Returns:
+        None
+    """
+    pipe = r.pipeline()
+    pipe.delete(f'worklog:{worklog_id}')
+    pipe.hset(f'worklog:{worklog_id}', mapping=encode_worklog(worklog, event_id))
+    pipe.execute()
+
+def unlink_worklog(event_id: str, worklog_id: str) -> None:
+    """
+    Forgets the worklog a calendar event was logged with, so the event is logged again as a new worklog.
+
+    Args:
+        event_id (str): The ID of the event.
+        worklog_id (str): The ID of the worklog.
+
+    Returns:
+        None
+    """
+    pipe = r.pipeline()
+    pipe.delete(f'worklog:{worklog_id}')
+    pipe.hdel(f'calEvent:{event_id}', 'jira_worklog_id', 'worklog_fingerprint', 'worklog_issue_key')
+    pipe.execute()
+
+def save_events(events: list) -> None:
+    """
+    Stores calendar events, their per-user date index and daily totals in one pipelined round trip.
+
+    Args:
+        events (list): List of events to be stored.
+
+    Returns:
+        None
+    """
+    pipe = r.pipeline(transaction=False)
+
+    for event in events:
+        event_id = event.get("event_id")
+        if not event_id:
+            continue
+
+        user_id = event.get("user_id")
+        args = [item for key, value in encode_event(event).items() for item in (key, value)]
+
+        # store a date index as YYYYMMDD for each event by user_id
+        keys = [f"calEvent:{event_id}", f'user:{user_id}:daily_seconds'] + ([f'user:{user_id}:calEvents'] if user_id else [])
+        update_event_script(keys=keys, args=args, client=pipe)
+
+    pipe.execute()
+
+def load_events(event_ids: list, fields: list = None) -> list:
+    """
+    Loads calendar events from Redis in one pipelined round trip.
+
+    Args:
+        event_ids (list): The IDs of the events to load.
+        fields (list, optional): The fields to load. Defaults to all fields.
+
+    Returns:
+        list: One dict per event ID, in the same order. Missing fields are None when `fields`
+        is given, and missing events are empty dicts otherwise.
+    """
+    pipe = r.pipeline(transaction=False)
+
+    # `v` tells the layouts apart and `duration` is stored for every event, so a missing event can be told from missing fields.
+    # Events in the old layout still have the derived fields stored
+    stored_fields = ['v', 'duration'] + [name for field in fields or [] for name in derived_fields.get(field, [field])] + legacy_fields
+    stored_fields = list(dict.fromkeys(stored_fields))
+
+    for event_id in event_ids:
+        if fields:
+            pipe.hmget(f'calEvent:{event_id}', stored_fields)
+        else:
+            pipe.hgetall(f'calEvent:{event_id}')
+
+    results = pipe.execute()
+
+    if fields:
+        events = [decode_event(event_id, dict(zip(stored_fields, values))) for event_id, values in zip(event_ids, results)]
+        return [{field: event.get(field) for field in fields} for event in events]
+
+    return [decode_event(event_id, values) for event_id, values in zip(event_ids, results)]
+
+def delete_events(events: list, user_id: str) -> None:
+    """
+    Deletes calendar events, their linked worklogs, their date index entries and their share of the daily totals in one pipelined round trip.
+
+    Args:
+        events (list): The events to delete. Each needs an `event_id`.
+        user_id (str): The Slack user ID that owns the events.
+
+    Returns:
+        None
+    """
+    pipe = r.pipeline(transaction=False)
+
+    for event in events:
+        delete_event_script(keys=[f"calEvent:{event['event_id']}", f'user:{user_id}:calEvents', f'user:{user_id}:daily_seconds'], args=[event['event_id']], client=pipe)
+
+    pipe.execute()
+
+def delete_event(event_id: str, user_id: str) -> str:
+    """
+    Deletes a calendar event, its linked worklog and its date index entry in one atomic call.
+
+    Args:
+        event_id (str): The ID of the event.
+        user_id (str): The Slack user ID that owns the event.
+
+    Returns:
+        str: The ID of the worklog that was linked to the event, or None.
+    """
+    return delete_event_script(keys=[f'calEvent:{event_id}', f'user:{user_id}:calEvents', f'user:{user_id}:daily_seconds'], args=[event_id])
+
+def delete_worklog(worklog_id: str, user_id: str) -> str:
+    """
+    Deletes a worklog, the calendar event it was logged for and the event's date index entry in one atomic call.
+
+    Args:
+        worklog_id (str): The ID of the worklog.
+        user_id (str): The Slack user ID that owns the worklog.
+
+    Returns:
+        str: The ID of the event the worklog was logged for, or None.
+    """
+    return delete_worklog_script(keys=[f'worklog:{worklog_id}', f'user:{user_id}:calEvents', f'user:{user_id}:daily_seconds'])
+
+def update_event(event_id: str, user_id: str, fields: dict) -> None:
+    """
+    Updates fields of a calendar event and keeps the user's date index and daily totals in line with its start and duration.
+
+    The event is written back whole, which also moves events stored in the old layout to the current one.
+
+    Args:
+        event_id (str): The ID of the event.
+        user_id (str): The Slack user ID that owns the event.
+        fields (dict): The fields to set.
+
+    Returns:
+        None
+    """
+    event = load_events([event_id])[0]
+    if not event:
+        return
+
+    # the end follows the start and duration unless it's given
+    if ('start' in fields or 'duration' in fields) and 'end' not in fields:
+        event.pop('end', None)
+
+    event.update(fields)
+    encoded = encode_event(event)
+
+    if 'end' not in event:
+        encoded['end'] = encoded['start'] + encoded['duration']
+
+    update_event_script(keys=[f'calEvent:{event_id}', f'user:{user_id}:daily_seconds', f'user:{user_id}:calEvents'], args=[item for key, value in encoded.items() for item in (key, value)])
+
+def expire_events(user_id: str, event_ids: list, unlogged_before: int, logged_before: int) -> list:
+    """
+    Deletes a user's calendar events that are past their retention, and drops index entries of events that are gone,
+    in one pipelined round trip.
+
+    Each event is checked again when it's deleted, so an event that was logged or moved in the meantime is kept.
+
+    Args:
+        user_id (str): The Slack user ID that owns the events.
+        event_ids (list): The IDs of the events to check.
+        unlogged_before (int): Events without a worklog that start before this day (YYYYMMDD) are deleted.
+        logged_before (int): Events with a worklog that start before this day (YYYYMMDD) are deleted, with their worklog.
+
+    Returns:
+        list: For each event, in the same order, 'expired', 'dangling' or None if it was kept.
+    """
+    pipe = r.pipeline(transaction=False)
+
+    for event_id in event_ids:
+        expire_event_script(keys=[f'calEvent:{event_id}', f'user:{user_id}:calEvents', f'user:{user_id}:daily_seconds'], args=[event_id, unlogged_before, logged_before], client=pipe)
+
+    return pipe.execute()
+
+def delete_orphan_events(event_ids: list) -> list:
+    """
+    Deletes calendar events that aren't in their user's date index, and their worklogs, in one pipelined round trip.
+
+    Args:
+        event_ids (list): The IDs of the events to check.
+
+    Returns:
+        list: For each event, in the same order, True if it was deleted.
+    """
+    pipe = r.pipeline(transaction=False)
+
+    for event_id in event_ids:
+        delete_orphan_event_script(keys=[f'calEvent:{event_id}'], args=[event_id], client=pipe)
+
+    return [bool(deleted) for deleted in pipe.execute()]
+
+def delete_orphan_worklogs(worklog_ids: list) -> list:
+    """
+    Deletes worklogs whose calendar event is gone in one pipelined round trip.
+
+    Args:
+        worklog_ids (list): The IDs of the worklogs to check.
+
+    Returns:
+        list: For each worklog, in the same order, True if it was deleted.
+    """
+    pipe = r.pipeline(transaction=False)
+
+    for worklog_id in worklog_ids:
+        delete_orphan_worklog_script(keys=[f'worklog:{worklog_id}'], client=pipe)
+
+    return [bool(deleted) for deleted in pipe.execute()]
+
+def load_daily_seconds(user_id: str, days: list) -> list:
+    """
+    Loads the seconds a user has on their calendar on a list of days.
+
+    The totals are kept up to date whenever an event is stored, updated or deleted. If they don't
+    exist yet they are first built from the user's stored events.
+
+    Args:
+        user_id (str): The Slack user ID.
+        days (list): The days as `YYYY-MM-DD` strings.
+
+    Returns:
+        list: The seconds for each day, in the same order.
+    """
+    pipe = r.pipeline(transaction=False)
+    pipe.exists(f'user:{user_id}:daily_seconds')
+    pipe.hmget(f'user:{user_id}:daily_seconds', days)
+    exists, seconds = pipe.execute()
+
+    if not exists:
+        rebuild_daily_seconds_script(keys=[f'user:{user_id}:calEvents', f'user:{user_id}:daily_seconds'])
+        seconds = r.hmget(f'user:{user_id}:daily_seconds', days)
+
+    return [int(value) if value else 0 for value in seconds]
+
+def load_users_daily_seconds(user_ids: list, days: list) -> list:
+    """
+    Loads the seconds several users have on their calendar on a list of days in one pipelined round trip.
+
+    Users whose totals don't exist yet get them built first, see load_daily_seconds.
+
+    Args:
+        user_ids (list): The Slack user IDs.
+        days (list): The days as `YYYY-MM-DD` strings.
+
+    Returns:
+        list: One list of seconds per user, in the order of `user_ids`, with the seconds for each day.
+    """
+    pipe = r.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.exists(f'user:{user_id}:daily_seconds')
+        pipe.hmget(f'user:{user_id}:daily_seconds', days)
+    results = pipe.execute()
+
+    seconds = results[1::2]
+    missing = [index for index, exists in enumerate(results[0::2]) if not exists]
+
+    if missing:
+        pipe = r.pipeline(transaction=False)
+        for index in missing:
+            rebuild_daily_seconds_script(keys=[f'user:{user_ids[index]}:calEvents', f'user:{user_ids[index]}:daily_seconds'], client=pipe)
+            pipe.hmget(f'user:{user_ids[index]}:daily_seconds', days)
+        for index, values in zip(missing, pipe.execute()[1::2]):
+            seconds[index] = values
+
+    return [[int(value) if value else 0 for value in values] for values in seconds]
@@ -1,14 +1,33 @@
-from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
+from google.oauth2.credentials import Credentials
+from gcal_credentials import get_credentials
 import datetime
-from utils import ( find_patterns, find_patterns_bool, send_confirmation_slack_message, make_tabular, convert_timezone, get_user_timezone )
+from utils import ( find_patterns, find_patterns_bool, send_confirmation_slack_message, make_tabular, convert_timezone, get_user_timezone, post_listing )
 from redis_conn import r
+from event_store import save_events, load_events, delete_events
 import json
+import os
+import asyncio
+import aiohttp
+import threading
 import slack
 import logging
 
 logger = logging.getLogger(__name__)
 
+# the window around the requested range that a full sync downloads
+sync_past_days = int(os.environ.get('GCAL_SYNC_PAST_DAYS', 60))
+sync_future_days = int(os.environ.get('GCAL_SYNC_FUTURE_DAYS', 30))
+
+# the Calendar API service is shared by every request, see get_calendar_service
+calendar_service = None
+calendar_service_lock = threading.Lock()
+
+
+class SyncTokenExpired(Exception):
+    """Raised when Google answers 410 Gone to a request with a syncToken, so a full sync is needed."""
+
 async def get_events_gcal(user_id: str, google_token_uri: str, google_client_id: str, google_client_secret: str, date_range: str, auth_stuff: dict, client: slack.WebClient, channel_id: str) -> None:
     """
     Retrieves events from Google Calendar based on the specified date range and filters them for FES events.
@@ -32,7 +51,7 @@ async def get_events_gcal(user_id: str, google_token_uri: str, google_client_id:
 
     if auth_stuff is None:
         # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"You haven't authorized me yet. Try running `/setup`")
+        await asyncio.to_thread(client.chat_postMessage, channel=channel_id, text=f"You haven't authorized me yet. Try running `/setup`")
         return
     
     auth_stuff = json.loads(auth_stuff) # convert string to dict
@@ -64,7 +83,7 @@ async def get_events_gcal(user_id: str, google_token_uri: str, google_client_id:
             end_date = (convert_timezone(datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f%z'), auth_stuff['user_timezone']) + datetime.timedelta(days=int(date_range[1]))).replace(hour=23, minute=59, second=59, microsecond=999999).isoformat()
         else:
             # Send a message to the user
-            client.chat_postMessage(channel=channel_id, text=f"Invalid date range. You provided {date_range[0]} {date_range[1]}")
+            await asyncio.to_thread(client.chat_postMessage, channel=channel_id, text=f"Invalid date range. You provided {date_range[0]} {date_range[1]}")
             return
     elif type(date_range) == list and date_range[0] == 'last':
         if date_range[1].isdigit():
@@ -73,60 +92,42 @@ async def get_events_gcal(user_id: str, google_token_uri: str, google_client_id:
             end_date = (convert_timezone(datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f%z'), auth_stuff['user_timezone']) - datetime.timedelta(days=1)).replace(hour=23, minute=59, second=59, microsecond=999999).isoformat()
         else:
             # Send a message to the user
-            client.chat_postMessage(channel=channel_id, text=f"Invalid date range. You provided {date_range[0]} {date_range[1]}")
+            await asyncio.to_thread(client.chat_postMessage, channel=channel_id, text=f"Invalid date range. You provided {date_range[0]} {date_range[1]}")
             return
     else:
         # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"Invalid date range. You provided {date_range}")
+        await asyncio.to_thread(client.chat_postMessage, channel=channel_id, text=f"Invalid date range. You provided {date_range}")
         return
 
     # save the start and end dates to redis by user_id as a hashset
-    r.hset(f'user:{user_id}:dates', 'start_date', start_date)
-    r.hset(f'user:{user_id}:dates', 'end_date', end_date)
+    await asyncio.to_thread(r.hset, f'user:{user_id}:dates', mapping={'start_date': start_date, 'end_date': end_date})
 
-    service = build('calendar', 'v3', credentials=Credentials(
-        token=auth_stuff['access_token'],
-        refresh_token=auth_stuff['refresh_token'],
-        token_uri=google_token_uri,
-        client_id=google_client_id,
-        client_secret=google_client_secret,
-        ))
+    credentials = await asyncio.to_thread(get_credentials, user_id, auth_stuff)
 
-    search_string = "FES"
+    # bring the user's cached calendar events up to date without blocking the event loop
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+        await sync_calendar_events(session, user_id, credentials, start_date, end_date)
 
-    # Call the Calendar API
-    logger.info(f'Getting the {search_string} events')
-    events_result = service.events().list(calendarId='primary', timeMin=start_date, timeMax=end_date,
-                                        singleEvents=True, q=search_string).execute()
-    # get items from events_result
-    events = events_result.get('items', [])
+    # read the window from the cache and send it to the user
+    await asyncio.to_thread(send_events_listing, user_id, start_date, end_date, new_date_range, auth_stuff, client, channel_id)
 
-    fes_events = []
+def send_events_listing(user_id: str, start_date: str, end_date: str, new_date_range: str, auth_stuff: dict, client: slack.WebClient, channel_id: str) -> None:
+    """
+    Sends the user's cached FES events between two dates to Slack with the confirmation buttons.
 
-    # filter events that return true and append Jira key to event
-    for event in events:
-        cleaned_event = {}
-        if find_patterns_bool(event['summary']):
-            start_date = datetime.datetime.fromisoformat(event['start'].get('dateTime', event['start'].get('date')))
-            start_str = event['start'].get('dateTime', event['start'].get('date'))
-            end = event['end'].get('dateTime', event['end'].get('date'))
-            duration = datetime.datetime.fromisoformat(end) - datetime.datetime.fromisoformat(start_str)
-            event_id = event['id']
-            cleaned_event = {
-                'event_id': event_id,
-                'summary': event['summary'],
-                'start': datetime.datetime.strftime(start_date,'%Y-%m-%dT%H:%M:%S.%f%z'),
-                'start_str': start_str, 
-                'end': end,
-                'duration': duration.seconds,
-                'jira_key': find_patterns(event['summary'].upper())[0],
-                'event_type': 'calendar',
-                'user_id': user_id,
-                'description': strip_description(event['description']) if 'description' in event else '',
-            }
-            fes_events.append(cleaned_event)
-    
-    store_events(fes_events)
+    Args:
+        user_id (str): The ID of the user.
+        start_date (str): The start of the range in ISO format.
+        end_date (str): The end of the range in ISO format.
+        new_date_range (str): The date range as shown to the user.
+        auth_stuff (dict): The authentication information for the user.
+        client (slack.WebClient): The Slack WebClient instance.
+        channel_id (str): The ID of the Slack channel to post messages to.
+
+    Returns:
+        None
+    """
+    fes_events = load_window_events(user_id, start_date, end_date)
 
     logger.info(f'Found {len(fes_events)} events')
 
@@ -153,17 +154,249 @@ async def get_events_gcal(user_id: str, google_token_uri: str, google_client_id:
 
         event_ids = [event['event_id'] for event in fes_events]
         
-        client.chat_postMessage(channel=channel_id, text=f'Here\'s what I found in your calendar:')
+        sections = []
+        for day in final_events:
+            sections.append((f"{day[0]['start_str'][:10]}:", make_tabular(day, client, user_id)))
 
-        for i in range(len(final_events)):
-            tabular_events = make_tabular(final_events[i], client, user_id)
-            message = f"```{tabular_events}```"
-            # send a message to the user
-            client.chat_postMessage(channel=channel_id, text=f"{final_events[i][0]['start_str'][:10]}:")
-            client.chat_postMessage(channel=channel_id, text=message)
+        # Send the listing and the confirmation buttons to the user
+        post_listing(client, channel_id, 'Here\'s what I found in your calendar:', sections, send_confirmation_slack_message(event_ids), filename='calendar-events.txt')
 
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, blocks=send_confirmation_slack_message(event_ids))
+def clean_event(event: dict, user_id: str) -> dict:
+    """
+    Converts a Google Calendar event into the calendar event we store in Redis.
+
+    Args:
+        event (dict): The event returned by the Calendar API.
+        user_id (str): The ID of the user.
+
+    Returns:
+        dict: The cleaned event, or None if the event has no Jira issue key in its title.
+    """
+    if not find_patterns_bool(event.get('summary', '')):
+        return None
+
+    start_date = datetime.datetime.fromisoformat(event['start'].get('dateTime', event['start'].get('date')))
+    start_str = event['start'].get('dateTime', event['start'].get('date'))
+    end = event['end'].get('dateTime', event['end'].get('date'))
+    duration = datetime.datetime.fromisoformat(end) - datetime.datetime.fromisoformat(start_str)
+
+    return {
+        'event_id': event['id'],
+        'summary': event['summary'],
+        'start': datetime.datetime.strftime(start_date,'%Y-%m-%dT%H:%M:%S.%f%z'),
+        'start_str': start_str,
+        'end': end,
+        'duration': duration.seconds,
+        'jira_key': find_patterns(event['summary'].upper())[0],
+        'event_type': 'calendar',
+        'user_id': user_id,
+        'description': strip_description(event['description']) if 'description' in event else '',
+    }
+
+def get_calendar_service():
+    """
+    Returns the process-wide Calendar API service, building it on first use.
+
+    The service is built from the discovery document bundled with the client library and without
+    credentials, so it can be shared. It is only used to build request URLs, which are fetched
+    with the user's credentials by `list_calendar_events`.
+
+    Returns:
+        The Calendar API service.
+    """
+    global calendar_service
+
+    with calendar_service_lock:
+        if calendar_service is None:
+            calendar_service = build('calendar', 'v3', http=build_http(), static_discovery=True, cache_discovery=False)
+
+    return calendar_service
+
+async def list_calendar_events(session: aiohttp.ClientSession, credentials: Credentials, calendar_id: str = 'primary', **params) -> tuple:
+    """
+    Lists calendar events without blocking the event loop, following every page of the result.
+
+    The request URLs are built with the shared Calendar API service and fetched with aiohttp.
+
+    Args:
+        session (aiohttp.ClientSession): The HTTP session to fetch with.
+        credentials (Credentials): The user's credentials.
+        calendar_id (str, optional): The calendar to list. Defaults to the user's primary calendar.
+        **params: The parameters passed on to `events.list`.
+
+    Returns:
+        tuple: The list of events and the `nextSyncToken` of the last page.
+
+    Raises:
+        SyncTokenExpired: If Google no longer accepts the `syncToken` in params.
+    """
+    headers = {'Authorization': f'Bearer {credentials.token}', 'Accept-Encoding': 'gzip'}
+    events = []
+    page_token = None
+
+    while True:
+        request = get_calendar_service().events().list(calendarId=calendar_id, pageToken=page_token, **params)
+        async with session.get(request.uri, headers=headers) as response:
+            if response.status == 410:
+                raise SyncTokenExpired(calendar_id)
+            response.raise_for_status()
+            events_result = await response.json()
+
+        events.extend(events_result.get('items', []))
+        page_token = events_result.get('nextPageToken')
+        if not page_token:
+            return events, events_result.get('nextSyncToken')
+
+async def list_calendars_events(session: aiohttp.ClientSession, credentials: Credentials, calendar_ids: list, **params) -> dict:
+    """
+    Lists the events of several calendars concurrently.
+
+    Args:
+        session (aiohttp.ClientSession): The HTTP session to fetch with.
+        credentials (Credentials): The credentials of the user that can read the calendars.
+        calendar_ids (list): The IDs of the calendars to list.
+        **params: The parameters passed on to `events.list`.
+
+    Returns:
+        dict: The `(events, nextSyncToken)` tuple of each calendar ID.
+    """
+    results = await asyncio.gather(*[list_calendar_events(session, credentials, calendar_id, **params) for calendar_id in calendar_ids])
+    return dict(zip(calendar_ids, results))
+
+async def sync_calendar_events(session: aiohttp.ClientSession, user_id: str, credentials: Credentials, start_date: str, end_date: str) -> None:
+    """
+    Brings the user's cached calendar events in Redis up to date with Google Calendar.
+
+    The first sync downloads every event in a window around the requested range and saves the
+    `nextSyncToken`. Later syncs only request what changed since then and apply new, changed and
+    cancelled events to the `calEvent:*` hashes and the `user:{id}:calEvents` index. A full sync is
+    done again when the requested range is outside the synced window or Google expires the token,
+    and drops cached events that are no longer in the window. Redis is only touched from a worker thread, so the event loop never blocks.
+
+    Args:
+        session (aiohttp.ClientSession): The HTTP session to fetch with.
+        user_id (str): The ID of the user.
+        credentials (Credentials): The user's credentials.
+        start_date (str): The start of the requested range in ISO format.
+        end_date (str): The end of the requested range in ISO format.
+
+    Returns:
+        None
+    """
+    sync_state = await asyncio.to_thread(r.hgetall, f'user:{user_id}:gcalSync')
+    requested_start = datetime.datetime.fromisoformat(start_date)
+    requested_end = datetime.datetime.fromisoformat(end_date)
+
+    if sync_state.get('sync_token') and datetime.datetime.fromisoformat(sync_state['window_start']) <= requested_start and requested_end <= datetime.datetime.fromisoformat(sync_state['window_end']):
+        try:
+            events, sync_token = await list_calendar_events(session, credentials, syncToken=sync_state['sync_token'], singleEvents=True)
+            logger.info(f'Applying {len(events)} changed calendar events for user {user_id}')
+            await asyncio.to_thread(apply_calendar_changes, user_id, events, sync_state['window_start'], sync_state['window_end'])
+            await asyncio.to_thread(r.hset, f'user:{user_id}:gcalSync', 'sync_token', sync_token)
+            return
+        except SyncTokenExpired:
+            logger.info(f'Sync token expired for user {user_id}, doing a full sync')
+
+    now = datetime.datetime.now(requested_start.tzinfo)
+    window_start = min(requested_start, now - datetime.timedelta(days=sync_past_days)).isoformat()
+    window_end = max(requested_end, now + datetime.timedelta(days=sync_future_days)).isoformat()
+
+    # sync tokens can't be combined with a search string, so the FES filter is applied locally
+    events, sync_token = await list_calendar_events(session, credentials, timeMin=window_start, timeMax=window_end, singleEvents=True)
+    logger.info(f'Fully synced {len(events)} calendar events for user {user_id}')
+    await asyncio.to_thread(apply_calendar_changes, user_id, events, window_start, window_end, True)
+
+    await asyncio.to_thread(r.hset, f'user:{user_id}:gcalSync', mapping={'sync_token': sync_token or '', 'window_start': window_start, 'window_end': window_end})
+
+def apply_calendar_changes(user_id: str, events: list, window_start: str, window_end: str, prune: bool = False) -> None:
+    """
+    Applies new, changed and cancelled Google Calendar events to the user's cached events.
+
+    Events that were cancelled, lost their Jira issue key or were moved out of the window are deleted,
+    unless time was already logged for them. Those are only flagged as cancelled, so `create_worklog`
+    can still delete their worklog when the user confirms a range without them.
+
+    Args:
+        user_id (str): The ID of the user.
+        events (list): The events returned by the Calendar API.
+        window_start (str): The start of the synced window in ISO format.
+        window_end (str): The end of the synced window in ISO format.
+
+    Returns:
+        None
+    """
+    window_start = datetime.datetime.fromisoformat(window_start)
+    window_end = datetime.datetime.fromisoformat(window_end)
+
+    changed_events = []
+    removed_event_ids = []
+
+    if prune:
+        listed_event_ids = set(event['id'] for event in events)
+        cached_event_ids = r.zrangebyscore(f'user:{user_id}:calEvents', window_start.strftime('%Y%m%d'), window_end.strftime('%Y%m%d'))
+        removed_event_ids.extend(event_id for event_id in cached_event_ids if event_id not in listed_event_ids)
+
+    for event in events:
+        cleaned_event = clean_event(event, user_id) if event.get('status') != 'cancelled' else None
+        if cleaned_event is None:
+            removed_event_ids.append(event['id'])
+            continue
+
+        start = datetime.datetime.fromisoformat(cleaned_event['start_str'])
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=window_start.tzinfo)
+        if window_start <= start <= window_end:
+            changed_events.append(cleaned_event)
+        else:
+            # the event was moved out of the window, so what's cached for it is at a time it no longer has
+            removed_event_ids.append(event['id'])
+
+    store_events(changed_events)
+
+    removed_events = load_events(removed_event_ids, ['jira_worklog_id'])
+    logged_event_ids = [event_id for event_id, event in zip(removed_event_ids, removed_events) if event['jira_worklog_id']]
+    delete_events([{'event_id': event_id} for event_id, event in zip(removed_event_ids, removed_events) if not event['jira_worklog_id']], user_id)
+
+    pipe = r.pipeline(transaction=False)
+    for event in changed_events:
+        pipe.hdel(f"calEvent:{event['event_id']}", 'cancelled')
+    for event_id in logged_event_ids:
+        pipe.hset(f'calEvent:{event_id}', 'cancelled', 1)
+    pipe.execute()
+
+def load_window_events(user_id: str, start_date: str, end_date: str) -> list:
+    """
+    Loads the user's cached FES events between two dates, ordered by start.
+
+    Args:
+        user_id (str): The ID of the user.
+        start_date (str): The start of the range in ISO format.
+        end_date (str): The end of the range in ISO format.
+
+    Returns:
+        list: The events in the range.
+    """
+    start = datetime.datetime.fromisoformat(start_date)
+    end = datetime.datetime.fromisoformat(end_date)
+
+    # the index is by day, so pad it by a day on each side and filter on the exact start below
+    event_ids = r.zrangebyscore(f'user:{user_id}:calEvents', (start - datetime.timedelta(days=1)).strftime('%Y%m%d'), (end + datetime.timedelta(days=1)).strftime('%Y%m%d'))
+
+    events = []
+    for event in load_events(event_ids):
+        if not event or event.get('cancelled'):
+            continue
+
+        event_start = datetime.datetime.fromisoformat(event['start_str'])
+        if event_start.tzinfo is None:
+            event_start = event_start.replace(tzinfo=start.tzinfo)
+        if start <= event_start <= end:
+            event['duration'] = int(event['duration'])
+            events.append(event)
+
+    events.sort(key=lambda event: event['start_str'])
+
+    return events
 
 def store_events(events: list) -> None:
     """
@@ -175,19 +408,7 @@ def store_events(events: list) -> None:
     Returns:
         None
     """
-    for event in events:
-        event_id = event.get("event_id")  # Assuming each event has a unique 'id' field
-        if event_id:
-            hash_key = f"calEvent:{event_id}"
-            for key, value in event.items():
-                r.hset(hash_key, key, str(value))
-        
-        # store a date index as YYYYMMDD for each event by user_id
-        user_id = event.get("user_id")
-        if user_id:
-            date = event.get("start_str")
-            date_index = datetime.datetime.fromisoformat(date).strftime('%Y%m%d')
-            r.zadd(f'user:{user_id}:calEvents', {event_id: date_index})
+    save_events(events)
 
 def strip_description(description: str) -> str:
     """
@@ -0,0 +1,203 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import redis
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from redis_conn import r
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+google_client_id = os.environ.get('GOOGLE_CLIENT_ID')
+google_client_secret = os.environ.get('GOOGLE_CLIENT_SECRET')
+google_token_url = os.environ.get('GOOGLE_TOKEN_URI')
+
+# tokens that expire within this many seconds are refreshed in the background
+refresh_margin = int(os.environ.get('GOOGLE_TOKEN_REFRESH_MARGIN', 300))
+
+# seconds between the token refreshes the workers schedule, see refresh_expiring_tokens
+refresh_interval = int(os.environ.get('GOOGLE_TOKEN_REFRESH_INTERVAL', 600))
+
+# tokens refreshed at the same time by a scheduled refresh
+refresh_workers = int(os.environ.get('GOOGLE_TOKEN_REFRESH_WORKERS', 4))
+
+# zset of user ID -> epoch seconds the user's access token expires at
+token_expiry_key = 'google:token_expiry'
+
+# users whose token is being refreshed in the background
+refreshing = set()
+refreshing_lock = threading.Lock()
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='google-token-refresh')
+
+
+def get_credentials(user_id: str, auth_stuff: dict) -> Credentials:
+    """
+    Returns Google credentials for a user with an access token that is still valid.
+
+    An expired token, or one saved before we stored expiries, is refreshed right away. A token that
+    expires within `GOOGLE_TOKEN_REFRESH_MARGIN` seconds is returned as is and refreshed in the
+    background. Tokens are normally refreshed ahead of time by refresh_expiring_tokens, so neither
+    should happen often on the request path.
+
+    Args:
+        user_id (str): The ID of the user.
+        auth_stuff (dict): The authentication information of the user.
+
+    Returns:
+        Credentials: The user's credentials.
+    """
+    credentials = make_credentials(auth_stuff)
+
+    if credentials.expiry is None or credentials.expired:
+        return refresh_credentials(user_id)
+
+    if credentials.expiry - datetime.datetime.utcnow() < datetime.timedelta(seconds=refresh_margin):
+        schedule_refresh(user_id)
+
+    return credentials
+
+def make_credentials(auth_stuff: dict) -> Credentials:
+    """
+    Builds Google credentials from the authentication information saved in Redis.
+
+    Args:
+        auth_stuff (dict): The authentication information of the user.
+
+    Returns:
+        Credentials: The user's credentials.
+    """
+    expiry = auth_stuff.get('expiry')
+
+    return Credentials(
+        token=auth_stuff['access_token'],
+        refresh_token=auth_stuff['refresh_token'],
+        token_uri=auth_stuff.get('token_uri') or google_token_url,
+        client_id=google_client_id,
+        client_secret=google_client_secret,
+        expiry=datetime.datetime.fromisoformat(expiry) if expiry else None,
+    )
+
+def refresh_credentials(user_id: str, margin: int = refresh_margin) -> Credentials:
+    """
+    Refreshes a user's access token and saves it with its expiry.
+
+    A Redis lock makes sure only one process refreshes a user's token at a time. Whoever waited
+    for the lock reuses the token the other process saved.
+
+    Args:
+        user_id (str): The ID of the user.
+        margin (int, optional): A token that is valid for longer than this many seconds isn't refreshed.
+            Defaults to `GOOGLE_TOKEN_REFRESH_MARGIN`.
+
+    Returns:
+        Credentials: The refreshed credentials.
+    """
+    with r.lock(f'lock:user:{user_id}:google_token', timeout=30, blocking_timeout=30):
+        auth_stuff = json.loads(r.get(f'user:{user_id}'))
+        credentials = make_credentials(auth_stuff)
+
+        if credentials.expiry is not None and credentials.expiry - datetime.datetime.utcnow() >= datetime.timedelta(seconds=margin):
+            # another process refreshed it while we waited
+            return credentials
+
+        credentials.refresh(Request())
+        save_token(user_id, credentials.token, credentials.expiry)
+        logger.info(f'Refreshed the Google access token of user {user_id}.')
+
+    return credentials
+
+def refresh_expiring_tokens() -> int:
+    """
+    Refreshes every access token that would expire before the next scheduled refresh, so users
+    don't wait on the token endpoint when they run a command.
+
+    Users get on the schedule whenever their token is saved. Users whose refresh token was revoked,
+    or who are gone, are taken off it.
+
+    Returns:
+        int: The number of tokens refreshed.
+    """
+    horizon = refresh_interval + refresh_margin
+    user_ids = r.zrangebyscore(token_expiry_key, '-inf', time.time() + horizon)
+
+    def refresh(user_id):
+        try:
+            if not r.exists(f'user:{user_id}'):
+                r.zrem(token_expiry_key, user_id)
+                return False
+            refresh_credentials(user_id, margin=horizon)
+            return True
+        except RefreshError:
+            logger.warning(f'Google refused to refresh the access token of user {user_id}, it was probably revoked.')
+            r.zrem(token_expiry_key, user_id)
+        except Exception:
+            logger.exception(f'Failed to refresh the Google access token of user {user_id}.')
+        return False
+
+    with ThreadPoolExecutor(max_workers=refresh_workers) as executor:
+        refreshed = sum(executor.map(refresh, user_ids))
+
+    logger.info(f'Refreshed {refreshed} of {len(user_ids)} expiring Google access tokens.')
+    return refreshed
+
+def schedule_refresh(user_id: str) -> None:
+    """
+    Refreshes a user's access token in the background, unless a refresh is already running.
+
+    Args:
+        user_id (str): The ID of the user.
+
+    Returns:
+        None
+    """
+    with refreshing_lock:
+        if user_id in refreshing:
+            return
+        refreshing.add(user_id)
+
+    def refresh():
+        try:
+            refresh_credentials(user_id)
+        except Exception:
+            logger.exception(f'Failed to refresh the Google access token of user {user_id}.')
+        finally:
+            with refreshing_lock:
+                refreshing.discard(user_id)
+
+    refresh_executor.submit(refresh)
+
+def save_token(user_id: str, access_token: str, expiry: datetime.datetime) -> None:
+    """
+    Writes an access token and its expiry back to `user:{id}` without clobbering concurrent changes to the other fields,
+    and puts the token on the refresh schedule.
+
+    Args:
+        user_id (str): The ID of the user.
+        access_token (str): The new access token.
+        expiry (datetime.datetime): When the token expires, as naive UTC.
+
+    Returns:
+        None
+    """
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(f'user:{user_id}')
+                auth_stuff = json.loads(pipe.get(f'user:{user_id}'))
+                auth_stuff['access_token'] = access_token
+                auth_stuff['expiry'] = expiry.isoformat()
+                pipe.multi()
+                pipe.set(f'user:{user_id}', json.dumps(auth_stuff))
+                pipe.zadd(token_expiry_key, {user_id: expiry.replace(tzinfo=datetime.timezone.utc).timestamp()})
+                pipe.execute()
+                return
+            except redis.WatchError:
+                continue
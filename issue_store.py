@@ -0,0 +1,139 @@
+import logging
+import math
+import os
+import time
+from dotenv import load_dotenv
+from jira_client import JiraClient
+from redis_conn import r
+from worklog_store import error_message
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# the statuses an issue counts as open in
+open_statuses = ['In Progress', 'On Hold']
+
+# issues fetched per search request, jira returns at most 100
+page_size = int(os.environ.get('JIRA_ISSUE_PAGE_SIZE', 100))
+
+# seconds a user's open issues are served without asking jira for changes
+refresh_interval = int(os.environ.get('JIRA_ISSUE_REFRESH_INTERVAL', 60))
+
+# seconds after which a user's open issues are fetched again in full
+max_incremental_age = int(os.environ.get('JIRA_ISSUE_MAX_INCREMENTAL_AGE', 86400))
+
+
+class IssueFetchError(Exception):
+    """Raised when jira refuses to search for issues."""
+
+
+def search_issues(jira: JiraClient, jql: str, fields: str) -> list:
+    """
+    Runs a JQL search and pages through all of its results with `startAt`.
+
+    Args:
+        jira (JiraClient): The Jira client to search with.
+        jql (str): The JQL query.
+        fields (str): The fields to return, comma separated.
+
+    Returns:
+        list: The issues.
+
+    Raises:
+        IssueFetchError: If jira rejects the search.
+    """
+    issues = []
+
+    while True:
+        response = jira.get('/rest/api/3/search', params={'jql': jql, 'fields': fields, 'startAt': len(issues), 'maxResults': page_size})
+
+        if response.status_code != 200:
+            raise IssueFetchError(error_message(response))
+
+        res = response.json()
+        issues.extend(res['issues'])
+
+        if len(res['issues']) == 0 or len(issues) >= res['total']:
+            return issues
+
+def is_open_issue(issue: dict, account_id: str) -> bool:
+    """
+    Tells whether an issue is an open FES issue assigned to an account.
+
+    Args:
+        issue (dict): The issue with its `status` and `assignee` fields.
+        account_id (str): The accountId of the user.
+
+    Returns:
+        bool: True if the issue belongs in the user's open issues.
+    """
+    assignee = issue['fields'].get('assignee') or {}
+
+    return issue['key'].startswith('FES-') and assignee.get('accountId') == account_id and issue['fields']['status']['name'] in open_statuses
+
+def load_open_issues(jira: JiraClient) -> list:
+    """
+    Returns the open FES issues assigned to the user of a Jira client from redis, syncing them with jira first when needed.
+
+    The issues are searched in full the first time and whenever the copy is more than
+    `JIRA_ISSUE_MAX_INCREMENTAL_AGE` seconds old. Otherwise only the issues updated since the last
+    sync are searched, at most once every `JIRA_ISSUE_REFRESH_INTERVAL` seconds, which adds the ones
+    that were opened or assigned to the user and drops the ones that were closed or reassigned.
+
+    Args:
+        jira (JiraClient): The Jira client of the user.
+
+    Returns:
+        list: `{'issue_key', 'summary'}` dicts, ordered by issue key.
+
+    Raises:
+        IssueFetchError: If jira rejects the search.
+    """
+    account_id = jira.get_account_id()
+    if account_id is None:
+        raise IssueFetchError("Couldn't look up your Jira account.")
+
+    key = f'jira:open_issues:{account_id}'
+
+    pipe = r.pipeline()
+    pipe.hgetall(key)
+    pipe.hgetall(f'{key}:meta')
+    issues, meta = pipe.execute()
+
+    now = time.time()
+    statuses = ', '.join(f'"{status}"' for status in open_statuses)
+
+    if not meta or now - int(meta['filled_at']) > max_incremental_age:
+        found = search_issues(jira, f'assignee = "{account_id}" AND project = FES AND status in ({statuses})', 'summary')
+        issues = {issue['key']: issue['fields']['summary'] for issue in found}
+
+        pipe = r.pipeline()
+        pipe.delete(key)
+        if issues:
+            pipe.hset(key, mapping=issues)
+        pipe.hset(f'{key}:meta', mapping={'synced_at': int(now), 'filled_at': int(now)})
+        pipe.execute()
+    elif now - int(meta['synced_at']) > refresh_interval:
+        # jira compares `updated` by the minute, so look back a minute further than the last sync
+        minutes = math.ceil((now - int(meta['synced_at'])) / 60) + 1
+        found = search_issues(jira, f'(assignee = "{account_id}" OR assignee was "{account_id}") AND project = FES AND updated >= "-{minutes}m"', 'summary,status,assignee')
+
+        opened = {issue['key']: issue['fields']['summary'] for issue in found if is_open_issue(issue, account_id)}
+        closed = [issue['key'] for issue in found if not is_open_issue(issue, account_id)]
+
+        pipe = r.pipeline()
+        if opened:
+            pipe.hset(key, mapping=opened)
+        if closed:
+            pipe.hdel(key, *closed)
+        pipe.hset(f'{key}:meta', 'synced_at', int(now))
+        pipe.execute()
+
+        issues.update(opened)
+        for issue_key in closed:
+            issues.pop(issue_key, None)
+
+        logger.info(f'Refreshed open issues of {jira.user_email}: {len(opened)} open, {len(closed)} closed or reassigned.')
+
+    return [{'issue_key': issue_key, 'summary': summary} for issue_key, summary in sorted(issues.items())]
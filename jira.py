@@ -1,25 +1,37 @@
-import requests
-from requests.auth import HTTPBasicAuth
+import hashlib
 import json
 import os
 from dotenv import load_dotenv 
 import redis_conn 
 import slack
+from jira_client import JiraClient, get_jira_client
+from worklog_store import load_issue_worklogs, WorklogFetchError
+from issue_store import load_open_issues, IssueFetchError
+from event_store import load_events, delete_events, delete_event, delete_worklog, update_event, save_worklog, unlink_worklog
 from utils import tabulate_dicts, make_date_friendly, get_user_timezone
 import datetime
 import logging
 import pytz
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-jira_url = os.environ.get('JIRA_BASE_URL')
+# max number of issues submitted in parallel for a single user
+user_concurrency = int(os.environ.get('JIRA_USER_CONCURRENCY', 5))
 
-headers = {
-   "Accept": "application/json",
-   "Content-Type": "application/json"
-}
+# max number of jira worklog writes in flight across the whole process
+global_jira_slots = threading.BoundedSemaphore(int(os.environ.get('JIRA_GLOBAL_CONCURRENCY', 20)))
+
+# (account_id, issue_key) -> whether the issue is assigned to that account
+assignment_cache = TTLCache(maxsize=4096, ttl=int(os.environ.get('JIRA_ASSIGNMENT_CACHE_TTL', 60)))
+assignment_cache_lock = threading.Lock()
+
+# worklogs per message when a worklog table is sent
+worklog_table_rows = int(os.environ.get('JIRA_WORKLOG_TABLE_ROWS', 50))
 
 
 def create_worklog(issue_keys: list, slack_user_id: str, client: slack.WebClient, channel_id: str) -> None:
@@ -38,111 +50,281 @@ def create_worklog(issue_keys: list, slack_user_id: str, client: slack.WebClient
 
     auth_stuff = get_auth_from_redis(slack_user_id)
 
-    gcal_event_ids = []
-
     # get user tz
     user_tz = pytz.timezone(auth_stuff['user_timezone'])
 
     # get calendar events from redis
-    events = []
-    keys = ['event_id', 'jira_key', 'summary', 'start', 'duration', 'jira_worklog_id', 'description']
-    for event_id in issue_keys:
-        event_data = redis_conn.r.hmget(f'calEvent:{event_id}',keys)
-        structured_event_data = dict(zip(keys, event_data))
-        events.append(structured_event_data)
-        gcal_event_ids.append(event_id)
+    keys = ['event_id', 'jira_key', 'summary', 'start', 'duration', 'jira_worklog_id', 'description', 'worklog_fingerprint', 'worklog_issue_key']
+    events = load_events(issue_keys, keys)
 
-    authentication = HTTPBasicAuth(auth_stuff['user_email'], auth_stuff['jira_api_token'])
+    jira = get_jira_client(auth_stuff)
 
     #get the min and max dates form redis
-    min_date = datetime.datetime.fromisoformat(redis_conn.r.hget(f'user:{slack_user_id}:dates', 'start_date'))
-    max_date = datetime.datetime.fromisoformat(redis_conn.r.hget(f'user:{slack_user_id}:dates', 'end_date'))
-
+    start_date, end_date = redis_conn.r.hmget(f'user:{slack_user_id}:dates', ['start_date', 'end_date'])
+    min_date = datetime.datetime.fromisoformat(start_date)
+    max_date = datetime.datetime.fromisoformat(end_date)
 
     # get list of stored events YYYMMDD between start and end from redis
     stored_events = redis_conn.r.zrangebyscore(f'user:{slack_user_id}:calEvents', min_date.strftime('%Y%m%d'), max_date.strftime('%Y%m%d'))
 
-    # compare stored events and gcal events to see if any are missing
-    for event in stored_events:
-        if event not in gcal_event_ids:
-            calendar_summary = redis_conn.r.hget(f'calEvent:{event}', 'summary')
-            calendar_start = redis_conn.r.hget(f'calEvent:{event}', 'start')
-            logger.info(f"Event {event} is missing from the list of events to be logged. Deleting from redis and Jira.")
-            # delete the worklog and cal event from redis
-            worklog_id = redis_conn.r.hget(f'calEvent:{event}', 'jira_worklog_id')
-            issue_key = redis_conn.r.hget(f'calEvent:{event}', 'jira_key')
-            redis_conn.r.delete(f'calEvent:{event}')
-            redis_conn.r.delete(f'worklog:{worklog_id}')
-            redis_conn.r.zrem(f'user:{slack_user_id}:calEvents', event)
-
-            # delete the worklog from jira
-            url = f'{jira_url}/rest/api/3/issue/{issue_key}/worklog/{worklog_id}'
-            response = requests.delete(url, headers=headers, auth=authentication)
-            logger.info(f"Worklog { worklog_id } for jira issue { issue_key } deleted successfully for user {auth_stuff['user_email']}.")
-
-            # send a message to the user
-            client.chat_postMessage(channel=channel_id, text=f"Worklog for calendar invite `{calendar_summary}` scheduled for `{make_date_friendly(calendar_start,user_tz)}` was deleted because you \
-                                    previously logged time for this event, but it's no longer on your calendar for this date range.")
+    plan = plan_reconciliation(issue_keys, events, stored_events)
+
+    # events that are stored for the date range but weren't confirmed are no longer on the calendar
+    stale_events = [dict(event, event_id=event_id) for event_id, event in zip(plan['delete'], load_events(plan['delete'], ['summary', 'start', 'jira_worklog_id', 'jira_key']))]
+
+    # delete the worklogs and cal events from redis
+    delete_events(stale_events, slack_user_id)
+
+    # only events with a worklog have anything to delete in jira
+    deleted, failed_deletes = delete_jira_worklogs([event for event in stale_events if event['jira_worklog_id']], jira)
 
     # successful worklog creations
     successes = []
     update_successes = []
 
-    # Make the request
-    for event in events:
-        # check to see if the issue is assigned to the user
-        if not is_issue_assigned_to_user(event['jira_key'], slack_user_id):
-            client.chat_postMessage(channel=channel_id, text=f":x: You are not assigned to `{event['jira_key']}`. Please assign yourself to the issue and try again or update your google calendar with the correct Jira Key.")
-            logger.info(f"User {auth_stuff['user_email']} is not assigned to {event['jira_key']}. Time will not be logged for this issue.")
-            continue
+    # check which issues are assigned to the user in one go
+    to_submit = plan['create'] + plan['update']
+    assigned_keys = get_assigned_issue_keys([event['jira_key'] for event in to_submit], jira)
 
-        try:   
-            worklog_id = int(event['jira_worklog_id'])
-            update_res = update_worklog(event['jira_key'], worklog_id, generate_worklog_entry(event)['worklog_data'], authentication, event['event_id'], client, channel_id, slack_user_id)
-            if update_res:
-                update_successes.append(f"{event['jira_key']} (worklog_id: {event['jira_worklog_id']})")
-                logger.info(f"Worklog { event['jira_worklog_id'] } for jira issue { event['jira_key'] } updated successfully for user {auth_stuff['user_email']}.")
-            else:
-                continue   
-        except TypeError:
-            # Construct the API endpoint URL for creating a worklog
-            url = f'{jira_url}/rest/api/3/issue/{event["jira_key"]}/worklog'
-            worklog_entry = generate_worklog_entry(event)
-            response = requests.post(url, headers=headers, data=json.dumps(worklog_entry['worklog_data']), auth=authentication)
+    # Make the requests
+    for status, label in submit_worklogs(to_submit, assigned_keys, jira, slack_user_id, client, channel_id):
+        if status == 'created':
+            successes.append(label)
+        elif status == 'updated':
+            update_successes.append(label)
 
-            # Check the response
-            if response.status_code == 201:
-                res = response.json()
+    # send one message with everything that changed
+    summary = []
 
-                worklog_id = res['id']
+    if len(successes) > 0:
+        summary.append(f":white_check_mark: Worklogs created successfully for {', '.join(successes)}.")
+
+    if len(update_successes) > 0:
+        summary.append(f":white_check_mark: Worklogs updated successfully for {', '.join(update_successes)}.")
+
+    if len(deleted) > 0:
+        summary.append(f":wastebasket: Worklogs deleted because you previously logged time for these events, but they're no longer on your calendar for this date range: " +
+                       ', '.join(f"`{event['summary']}` scheduled for `{make_date_friendly(event['start'], user_tz)}`" for event in deleted) + '.')
+
+    if len(plan['unchanged']) > 0:
+        summary.append(f":heavy_minus_sign: Worklogs unchanged, nothing sent to Jira for " +
+                       ', '.join(f"{event['jira_key']} (worklog_id: {event['jira_worklog_id']})" for event in plan['unchanged']) + '.')
 
-                for key, val in res.items():
-                    redis_conn.r.hset(f'worklog:{worklog_id}', key, json.dumps(val))
-                
-                #add the calendar event id to the worklog
-                redis_conn.r.hset(f'worklog:{worklog_id}', 'event_id', event['event_id'])
+    if len(failed_deletes) > 0:
+        summary.append(f":x: Failed to delete the worklogs of events that are no longer on your calendar: " +
+                       ', '.join(f"{event['jira_key']} (worklog_id: {event['jira_worklog_id']})" for event in failed_deletes) + '.')
 
-                # Update the Calendar event with the worklog ID
-                redis_conn.r.hset(f'calEvent:{event["event_id"]}', 'jira_worklog_id', int(worklog_id))
+    if len(plan['skip']) > 0:
+        summary.append(f"Skipped {len(plan['skip'])} events that were removed from your calendar after they were listed.")
 
-                # add issue to successful worklogs
-                successes.append(f"{event['jira_key']} (worklog_id: {worklog_id})")
+    if len(summary) > 0:
+        client.chat_postMessage(channel=channel_id, text='\n'.join(summary))
+
+def plan_reconciliation(confirmed_ids: list, events: list, stored_ids: list) -> dict:
+    """
+    Works out what has to happen in Jira to match the events the user confirmed.
+
+    Args:
+        confirmed_ids (list): The IDs of the events the user confirmed.
+        events (list): The confirmed events loaded from redis, in the order of `confirmed_ids`.
+        stored_ids (list): The IDs of the events stored for the confirmed date range.
 
-                logger.info(f"Worklog { worklog_id } for jira issue { event['jira_key'] } created successfully for user {auth_stuff['user_email']}.")
+    Returns:
+        dict: The plan. `create` and `update` hold the events that need a new or an updated worklog,
+        `unchanged` the events whose worklog already matches, `delete` the IDs of stored events that
+        weren't confirmed and `skip` the IDs of confirmed events that aren't stored anymore.
+    """
+    plan = {'create': [], 'update': [], 'unchanged': [], 'delete': [], 'skip': []}
+
+    for event_id, event in zip(confirmed_ids, events):
+        if event['event_id'] is None:
+            plan['skip'].append(event_id)
+        elif event['jira_worklog_id'] is not None:
+            # the worklog was last written with exactly this payload, a PUT wouldn't change anything
+            if event['worklog_fingerprint'] == worklog_fingerprint(generate_worklog_entry(event)):
+                plan['unchanged'].append(event)
             else:
-                #send a message to the user
-                client.chat_postMessage(channel=channel_id, text=f":x: Failed to create worklog for {event['jira_key']}. \n Jira responded with: {response.text}")
-                logger.error(f"Failed to create worklog for {event['jira_key']}. \n Jira responded with: {response.text}")
-
-        finally:
-            pass
-            
-    # todo: send message with all worklogs created
-    if len(successes) > 0:
-        client.chat_postMessage(channel=channel_id, text=f":white_check_mark: Worklogs created successfully for {', '.join(successes)}.")
+                plan['update'].append(event)
+        else:
+            plan['create'].append(event)
 
-    if len(update_successes) > 0:
-        client.chat_postMessage(channel=channel_id, text=f":white_check_mark: Worklogs updated successfully for {', '.join(update_successes)}.")
+    confirmed = set(confirmed_ids)
+    plan['delete'] = [event_id for event_id in stored_ids if event_id not in confirmed]
+
+    return plan
+
+def delete_jira_worklogs(events: list, jira: JiraClient) -> tuple:
+    """
+    Deletes the Jira worklogs of calendar events concurrently.
+
+    Args:
+        events (list): The events, each with a `jira_key` and a `jira_worklog_id`.
+        jira (JiraClient): The Jira client of the user.
+
+    Returns:
+        tuple: The events whose worklog was deleted, and the events whose worklog couldn't be deleted.
+    """
+    if not events:
+        return [], []
+
+    def delete(event):
+        try:
+            with global_jira_slots:
+                response = jira.delete(f"/rest/api/3/issue/{event['jira_key']}/worklog/{event['jira_worklog_id']}")
+        except Exception:
+            logger.exception(f"Failed to delete worklog {event['jira_worklog_id']} for jira issue {event['jira_key']}.")
+            return False
+
+        # a worklog that's already gone in jira is as good as deleted
+        if response.status_code not in (204, 404):
+            logger.error(f"Failed to delete worklog {event['jira_worklog_id']} for jira issue {event['jira_key']}. \n Jira responded with: {response.text}")
+            return False
+
+        logger.info(f"Worklog {event['jira_worklog_id']} for jira issue {event['jira_key']} deleted successfully for user {jira.user_email}.")
+        return True
+
+    with ThreadPoolExecutor(max_workers=min(user_concurrency, len(events))) as executor:
+        results = list(executor.map(delete, events))
+
+    deleted = [event for event, ok in zip(events, results) if ok]
+    failed = [event for event, ok in zip(events, results) if not ok]
+
+    return deleted, failed
+
+def submit_worklogs(events: list, assigned_keys: set, jira: JiraClient, slack_user_id: str, client: slack.WebClient, channel_id: str) -> list:
+    """
+    Submits worklogs for the given events concurrently.
+
+    Events are grouped by Jira issue key. Each group is submitted serially, so worklogs for the same
+    issue keep their order, while different issues run in parallel. At most `JIRA_USER_CONCURRENCY`
+    issues run at once for this user and at most `JIRA_GLOBAL_CONCURRENCY` Jira writes run at once
+    across the whole process.
+
+    Args:
+        events (list): List of calendar events loaded from redis.
+        assigned_keys (set): The Jira issue keys assigned to the user.
+        jira (JiraClient): The Jira client of the user.
+        slack_user_id (str): Slack user ID.
+        client (slack.WebClient): Slack WebClient instance.
+        channel_id (str): Slack channel ID.
+
+    Returns:
+        list: A `(status, label)` tuple per event, in the order of `events`. Status is `created`, `updated` or None.
+    """
+    events_by_issue = {}
+    for index, event in enumerate(events):
+        events_by_issue.setdefault(event['jira_key'], []).append((index, event))
+
+    outcomes = [(None, None)] * len(events)
+
+    if not events_by_issue:
+        return outcomes
+
+    with ThreadPoolExecutor(max_workers=min(user_concurrency, len(events_by_issue))) as executor:
+        futures = [executor.submit(submit_issue_worklogs, issue_events, assigned_keys, jira, slack_user_id, client, channel_id) for issue_events in events_by_issue.values()]
+        for future in futures:
+            for index, outcome in future.result():
+                outcomes[index] = outcome
+
+    return outcomes
+
+def submit_issue_worklogs(issue_events: list, assigned_keys: set, jira: JiraClient, slack_user_id: str, client: slack.WebClient, channel_id: str) -> list:
+    """
+    Submits the worklogs of a single Jira issue one after another.
+
+    Args:
+        issue_events (list): List of `(index, event)` tuples that share a Jira issue key.
+        assigned_keys (set): The Jira issue keys assigned to the user.
+        jira (JiraClient): The Jira client of the user.
+        slack_user_id (str): Slack user ID.
+        client (slack.WebClient): Slack WebClient instance.
+        channel_id (str): Slack channel ID.
+
+    Returns:
+        list: A list of `(index, (status, label))` tuples.
+    """
+    outcomes = []
+    for index, event in issue_events:
+        try:
+            with global_jira_slots:
+                outcome = submit_worklog(event, event['jira_key'] in assigned_keys, jira, slack_user_id, client, channel_id)
+        except Exception:
+            logger.exception(f"Failed to submit worklog for event {event['event_id']} on {event['jira_key']}.")
+            client.chat_postMessage(channel=channel_id, text=f":x: Failed to log time for {event['jira_key']}. Please try again.")
+            outcome = (None, None)
+        outcomes.append((index, outcome))
+
+    return outcomes
+
+def submit_worklog(event: dict, is_assigned: bool, jira: JiraClient, slack_user_id: str, client: slack.WebClient, channel_id: str) -> tuple:
+    """
+    Creates or updates the Jira worklog for a single calendar event.
+
+    Args:
+        event (dict): The calendar event loaded from redis.
+        is_assigned (bool): Whether the event's Jira issue is assigned to the user.
+        jira (JiraClient): The Jira client of the user.
+        slack_user_id (str): Slack user ID.
+        client (slack.WebClient): Slack WebClient instance.
+        channel_id (str): Slack channel ID.
+
+    Returns:
+        tuple: `(status, label)` where status is `created`, `updated` or None if nothing was logged.
+    """
+    # check to see if the issue is assigned to the user
+    if not is_assigned:
+        client.chat_postMessage(channel=channel_id, text=f":x: You are not assigned to `{event['jira_key']}`. Please assign yourself to the issue and try again or update your google calendar with the correct Jira Key.")
+        logger.info(f"User {jira.user_email} is not assigned to {event['jira_key']}. Time will not be logged for this issue.")
+        return (None, None)
+
+    # the event's title moved to another issue, the worklog can't follow it there so it's logged again
+    if event['jira_worklog_id'] is not None and event.get('worklog_issue_key') and event['worklog_issue_key'] != event['jira_key']:
+        response = jira.delete(f"/rest/api/3/issue/{event['worklog_issue_key']}/worklog/{event['jira_worklog_id']}")
+        if response.status_code not in (204, 404):
+            client.chat_postMessage(channel=channel_id, text=f":x: Failed to move the worklog of `{event['summary']}` from {event['worklog_issue_key']} to {event['jira_key']}. \n Jira responded with: {response.text}")
+            logger.error(f"Failed to delete worklog {event['jira_worklog_id']} from {event['worklog_issue_key']}. \n Jira responded with: {response.text}")
+            return (None, None)
+
+        unlink_worklog(event['event_id'], event['jira_worklog_id'])
+        logger.info(f"Worklog {event['jira_worklog_id']} deleted from {event['worklog_issue_key']} because its event moved to {event['jira_key']}.")
+        event = dict(event, jira_worklog_id=None)
+
+    if event['jira_worklog_id'] is not None:
+        worklog_id = int(event['jira_worklog_id'])
+        update_res = update_worklog(event['jira_key'], worklog_id, generate_worklog_entry(event), jira, event['event_id'], client, channel_id, slack_user_id)
+        if not update_res:
+            return (None, None)
+
+        logger.info(f"Worklog { event['jira_worklog_id'] } for jira issue { event['jira_key'] } updated successfully for user {jira.user_email}.")
+        return ('updated', f"{event['jira_key']} (worklog_id: {event['jira_worklog_id']})")
+
+    # Construct the API endpoint URL for creating a worklog
+    worklog_entry = generate_worklog_entry(event)
+    response = jira.post(f'/rest/api/3/issue/{event["jira_key"]}/worklog', data=json.dumps(worklog_entry['worklog_data']))
+
+    # Check the response
+    if response.status_code != 201:
+        #send a message to the user
+        client.chat_postMessage(channel=channel_id, text=f":x: Failed to create worklog for {event['jira_key']}. \n Jira responded with: {response.text}")
+        logger.error(f"Failed to create worklog for {event['jira_key']}. \n Jira responded with: {response.text}")
+        return (None, None)
+
+    res = response.json()
+
+    worklog_id = res['id']
+
+    # store the worklog with the calendar event id it was logged for
+    save_worklog(worklog_id, res, event['event_id'])
+
+    # Update the Calendar event with the worklog ID and what it was logged with
+    redis_conn.r.hset(f'calEvent:{event["event_id"]}', mapping={
+        'jira_worklog_id': int(worklog_id),
+        'worklog_fingerprint': worklog_fingerprint(worklog_entry),
+        'worklog_issue_key': event['jira_key'],
+    })
+
+    logger.info(f"Worklog { worklog_id } for jira issue { event['jira_key'] } created successfully for user {jira.user_email}.")
+    return ('created', f"{event['jira_key']} (worklog_id: {worklog_id})")
 
 def get_issue_worklogs(issue_key: str, auth_stuff: dict, channel_id: str, client: slack.WebClient, user_id: str) -> None:
     """
@@ -160,70 +342,53 @@ def get_issue_worklogs(issue_key: str, auth_stuff: dict, channel_id: str, client
     """
 
 
-    # Construct the API endpoint URL for creating a worklog
-    url = f'{jira_url}/rest/api/3/issue/{issue_key}/worklog'
-
     # user email
     user_email = json.loads(auth_stuff)['user_email']
 
-    #api token
-    api_token = json.loads(auth_stuff)['jira_api_token']
-
-    # todo: user user_email in production
-    authentication = HTTPBasicAuth(user_email, api_token)
-
-    # Make the request
-    response = requests.get(url, headers=headers, auth=authentication)
-
-    # Check the response
-    if response.status_code == 200:
-        res = response.json()
-
-        if res['total'] == 0:
-            logger.info(f"No worklogs found for {issue_key}.")
-            client.chat_postMessage(channel=channel_id, text=f"No worklogs found for {issue_key}.")
-            return ['No worklogs found.']
-
-        worklogs = []
+    jira = get_jira_client(json.loads(auth_stuff))
 
-        # get user tz
-        user_tz = get_user_timezone(user_id, client)
+    try:
+        worklogs = load_issue_worklogs(issue_key, jira)
+    except WorklogFetchError as e:
+        # Send a message to the user
+        client.chat_postMessage(channel=channel_id, text=f"Failed to retrieve worklogs for {issue_key.upper()}.\n Response from Jira: {e}")
+        logger.info(f"Failed to retrieve worklogs for {issue_key.upper()}.\n Response from Jira: {e}")
+        return
 
-        for worklog in res['worklogs']:
-            temp_dict = {
-                'worklog_id': worklog['id'],
-                'issue_key': issue_key.upper(),
-                'author_display_name': worklog['author']['displayName'],
-                'started': make_date_friendly(worklog['started'], user_tz),
-                'time_spent': worklog['timeSpent'],
-            }
+    if len(worklogs) == 0:
+        logger.info(f"No worklogs found for {issue_key}.")
+        client.chat_postMessage(channel=channel_id, text=f"No worklogs found for {issue_key}.")
+        return
 
-            worklogs.append(temp_dict)
+    logger.info(f'Worklogs retrieved successfully. We found {len(worklogs)} worklogs for user {user_email}.')
 
-        logger.info(f'Worklogs retrieved successfully. We found {len(worklogs)} worklogs for user {user_email}.')
+    # get user tz
+    user_tz = get_user_timezone(user_id, client)
 
-        primer = f"Here are the worklogs for {issue_key.upper()}:"
-        content = f'```{tabulate_dicts(worklogs)}```'
+    # Send a message to the user
+    client.chat_postMessage(channel=channel_id, text=f"Here are the {len(worklogs)} worklogs for {issue_key.upper()}:")
 
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=primer)
-        client.chat_postMessage(channel=channel_id, text=content)
+    # render and send the table a page at a time
+    for i in range(0, len(worklogs), worklog_table_rows):
+        rows = [{
+            'worklog_id': worklog['id'],
+            'issue_key': issue_key.upper(),
+            'author_display_name': worklog['author'],
+            'started': make_date_friendly(worklog['started'], user_tz),
+            'time_spent': worklog['time_spent'],
+        } for worklog in worklogs[i:i + worklog_table_rows]]
 
-    else:
-        res = response.json()
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"Failed to retrieve worklogs for {issue_key.upper()}.\n Response from Jira: {res['errorMessages'][0]}")
-        logger.info(f"Failed to retrieve worklogs for {issue_key.upper()}.\n Response from Jira: {res['errorMessages'][0]}")
+        client.chat_postMessage(channel=channel_id, text=f'```{tabulate_dicts(rows)}```')
 
-def update_worklog(issue_key: str, worklog_id: str, worklog_data: dict, authentication: HTTPBasicAuth, event_id: str, client: slack.WebClient, channel_id: str, user: str) -> bool:
+def update_worklog(issue_key: str, worklog_id: str, worklog_entry: dict, jira: JiraClient, event_id: str, client: slack.WebClient, channel_id: str, user: str) -> bool:
     """
     Updates the worklog for a specific issue in Jira.
 
     Args:
         issue_key (str): The key of the issue.
         worklog_id (str): The ID of the worklog to be updated.
-        worklog_data (dict): The data to be updated in the worklog.
-        authentication (HTTPBasicAuth): The authentication credentials for accessing the Jira API.
+        worklog_entry (dict): The worklog entry to update the worklog with, see generate_worklog_entry.
+        jira (JiraClient): The Jira client of the user.
         event_id (str): The ID of the associated calendar event.
         client (slack.WebClient): The Slack WebClient instance for sending messages.
         channel_id (str): The ID of the Slack channel to send messages to.
@@ -231,40 +396,40 @@ def update_worklog(issue_key: str, worklog_id: str, worklog_data: dict, authenti
     Returns:
         None
     """
-    # Construct the API endpoint URL for creating a worklog
-    url = f'{jira_url}/rest/api/3/issue/{issue_key}/worklog/{worklog_id}'
+    worklog_data = worklog_entry['worklog_data']
+
+    # Construct the API endpoint URL for updating a worklog
+    url = f'/rest/api/3/issue/{issue_key}/worklog/{worklog_id}'
 
     # Make the request
-    response = requests.put(url, headers=headers, data=json.dumps(worklog_data), auth=authentication)
+    response = jira.put(url, data=json.dumps(worklog_data))
 
     # Check the response
     if response.status_code == 200:
         res = response.json()
 
-        for key, val in res.items():
-            redis_conn.r.hset(f'worklog:{worklog_id}', key, json.dumps(val))
+        save_worklog(worklog_id, res, event_id)
 
         cal_update = {
                 'jira_worklog_id': worklog_id,
                 'duration': res['timeSpentSeconds'],
-                'start': res['started']
+                'start': res['started'],
+                'worklog_fingerprint': worklog_fingerprint(worklog_entry),
+                'worklog_issue_key': issue_key,
             }
         
         # Update the Calendar event with the worklog ID
-        for key, value in cal_update.items():
-            redis_conn.r.hset(f'calEvent:{event_id}', key, value)
+        update_event(event_id, user, cal_update)
 
         # return success
         return True
     
     else:
         # delete the cal event and worklog from redis
-        redis_conn.r.delete(f'calEvent:{event_id}')
-        redis_conn.r.delete(f'worklog:{worklog_id}')
+        delete_event(event_id, user)
 
         #delete worklog in jira
-        url = f'{jira_url}/rest/api/3/issue/{issue_key}/worklog/{worklog_id}'
-        del_res = requests.delete(url, headers=headers, auth=authentication)
+        del_res = jira.delete(url)
 
         if del_res.status_code == 204:
             logger.info(f"Worklog { worklog_id } for jira issue { issue_key } deleted successfully.")
@@ -325,6 +490,25 @@ def generate_worklog_entry(event: dict) -> dict:
 
     return worklog_entry
 
+def worklog_fingerprint(worklog_entry: dict) -> str:
+    """
+    Hashes what a worklog is logged with: the issue, when it started, how long it took and its comment.
+
+    The start is compared as a timestamp, because Jira sends it back in a different format than Google.
+
+    Args:
+        worklog_entry (dict): The worklog entry, see generate_worklog_entry.
+
+    Returns:
+        str: The hex SHA-256 of the worklog entry.
+    """
+    worklog_data = worklog_entry['worklog_data']
+    started = int(parse_isoformat_with_timezone(worklog_data['started']).timestamp())
+    seconds = int(float(worklog_data['timeSpentSeconds']))
+    comment = json.dumps(worklog_data['comment'], sort_keys=True)
+
+    return hashlib.sha256(f"{worklog_entry['issue_key']}|{started}|{seconds}|{comment}".encode()).hexdigest()
+
 def delete_worklog_by_id(text: list, slack_user_id: str, client: slack.WebClient, channel_id: str, auth_stuff: dict) -> None:
     """
     Deletes a worklog entry in Jira by its ID.
@@ -344,26 +528,17 @@ def delete_worklog_by_id(text: list, slack_user_id: str, client: slack.WebClient
     worklog_id = text[1]
     issue_key = text[0]
 
-    # get event id from redis worklog
-    event_id = redis_conn.r.hget(f'worklog:{worklog_id}', 'event_id')
-
-    # Construct the API endpoint URL for creating a worklog
-    url = f'{jira_url}/rest/api/3/issue/{issue_key}/worklog/{worklog_id}'
-
     user_email = json.loads(auth_stuff)['user_email']
-    api_token = json.loads(auth_stuff)['jira_api_token']
 
-    # delete the worklog
-    authentication = HTTPBasicAuth(user_email, api_token)
+    jira = get_jira_client(json.loads(auth_stuff))
     
     # Make the request
-    response = requests.delete(url, headers=headers, auth=authentication)
+    response = jira.delete(f'/rest/api/3/issue/{issue_key}/worklog/{worklog_id}')
 
     # Check the response
     if response.status_code == 204:
         logger.info(f"Worklog { worklog_id } for jira issue { issue_key } deleted successfully for user {user_email}.")
-        redis_conn.r.delete(f'worklog:{worklog_id}')
-        redis_conn.r.delete(f'calEvent:{event_id}')
+        delete_worklog(worklog_id, slack_user_id)
 
         #send a message to the user
         client.chat_postMessage(channel=channel_id, text=f"Worklog deleted successfully.")  
@@ -390,28 +565,69 @@ def is_issue_assigned_to_user(issue_key: str, slack_user_id: str) -> bool:
 
     auth_stuff = get_auth_from_redis(slack_user_id)
 
-    # user email
-    user_email = auth_stuff['user_email']
+    return issue_key in get_assigned_issue_keys([issue_key], get_jira_client(auth_stuff))
 
-    #api token
-    api_token = auth_stuff['jira_api_token']
+def get_assigned_issue_keys(issue_keys: list, jira: JiraClient) -> set:
+    """
+    Returns which of the given Jira issues are assigned to the user of the Jira client.
 
-    # only return the assignee field
-    fields = 'assignee'
+    The keys are deduplicated and looked up with a single JQL search per 100 keys. Assignees are
+    compared by accountId, because Jira may hide the assignee's email address. Results are kept in
+    a short lived cache.
 
-    # gather the issue data from jira
-    url = f'{jira_url}/rest/api/3/issue/{issue_key}'
-    authentication = HTTPBasicAuth(user_email, api_token)
-    params = {'fields': fields}
-    response = requests.get(url, headers=headers, auth=authentication, params=params)
-    res = response.json()
+    Args:
+        issue_keys (list): The keys of the Jira issues.
+        jira (JiraClient): The Jira client of the user.
 
-    # check if the user is the assignee
-    if type(res['fields']['assignee']) == dict:
-        if res['fields']['assignee'].get('emailAddress', None) == user_email:
-            return True
-    else:
-        return False
+    Returns:
+        set: The issue keys that are assigned to the user.
+    """
+
+    account_id = jira.get_account_id()
+    if account_id is None:
+        logger.error(f"Could not get the Jira account of {jira.user_email}.")
+        return set()
+
+    assigned = set()
+    missing = []
+
+    with assignment_cache_lock:
+        for issue_key in set(key for key in issue_keys if key):
+            cached = assignment_cache.get((account_id, issue_key))
+            if cached is None:
+                missing.append(issue_key)
+            elif cached:
+                assigned.add(issue_key)
+
+    for i in range(0, len(missing), 100):
+        chunk = missing[i:i + 100]
+
+        # only return the assignee field
+        params = {
+            'jql': f'key in ({", ".join(chunk)})',
+            'fields': 'assignee',
+            'maxResults': len(chunk),
+            'validateQuery': 'warn',
+        }
+        response = jira.get('/rest/api/3/search', params=params)
+
+        if response.status_code != 200:
+            logger.error(f"Failed to check the assignee of {chunk}. \n Jira responded with: {response.text}")
+            continue
+
+        results = {}
+        for issue in response.json()['issues']:
+            assignee = issue['fields']['assignee']
+            results[issue['key']] = type(assignee) == dict and assignee.get('accountId') == account_id
+
+        with assignment_cache_lock:
+            for issue_key in chunk:
+                is_assigned = results.get(issue_key, False)
+                assignment_cache[(account_id, issue_key)] = is_assigned
+                if is_assigned:
+                    assigned.add(issue_key)
+
+    return assigned
 
 def parse_isoformat_with_timezone(dt_str):
     """
@@ -444,57 +660,29 @@ def get_jira_issues_for_user(auth_stuff: dict, client: slack.WebClient, channel_
     """
 
 
-    # Construct the API endpoint URL for creating a worklog
-    url = f'{jira_url}/rest/api/3/search'
-
     # user email
     user_email = json.loads(auth_stuff)['user_email']
 
-    #api token
-    api_token = json.loads(auth_stuff)['jira_api_token']
+    jira = get_jira_client(json.loads(auth_stuff))
 
-    jql = f'assignee = "{user_email}" AND project = FES AND status in ("In Progress", "On Hold")'
-
-    authentication = HTTPBasicAuth(user_email, api_token)
-
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
-
-    params = {
-        'jql': jql,
-        'fields': 'summary, key'
-    }
-
-    # Make the request
-    response = requests.get(url, headers=headers, params=params, auth=authentication)
-
-    # Check the response
-
-    if response.status_code == 200:
-        res = response.json()
-
-        if res['total'] == 0:
-            logger.info(f"No issues found for {user_email}.")
-            client.chat_postMessage(channel=channel_id, text=f"No issues found for {user_email}.")
-            return ['No issues found.']
-
-        issues = []
-
-        for issue in res['issues']:
-            temp_dict = {
-                'issue_key': issue['key'],
-                'summary': issue['fields']['summary'],
-            }
+    try:
+        issues = load_open_issues(jira)
+    except IssueFetchError as e:
+        # Send a message to the user
+        client.chat_postMessage(channel=channel_id, text=f"Failed to retrieve your issues.\n Response from Jira: {e}")
+        logger.info(f"Failed to retrieve issues for {user_email}.\n Response from Jira: {e}")
+        return
 
-            issues.append(temp_dict)
+    if len(issues) == 0:
+        logger.info(f"No issues found for {user_email}.")
+        client.chat_postMessage(channel=channel_id, text=f"No issues found for {user_email}.")
+        return ['No issues found.']
 
-        logger.info(f'Issues retrieved successfully. We found {len(issues)} issues for user {user_email}.')
+    logger.info(f'Issues retrieved successfully. We found {len(issues)} issues for user {user_email}.')
 
-        primer = f"Here are the issues for {user_email}:"
-        content = f'```{tabulate_dicts(issues)}```'
+    primer = f"Here are the issues for {user_email}:"
+    content = f'```{tabulate_dicts(issues)}```'
 
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=primer)
-        client.chat_postMessage(channel=channel_id, text=content)
\ No newline at end of file
+    # Send a message to the user
+    client.chat_postMessage(channel=channel_id, text=primer)
+    client.chat_postMessage(channel=channel_id, text=content)
\ No newline at end of file
@@ -0,0 +1,136 @@
+import os
+import threading
+from dotenv import load_dotenv
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+load_dotenv()
+
+jira_url = os.environ.get('JIRA_BASE_URL')
+
+connect_timeout = float(os.environ.get('JIRA_CONNECT_TIMEOUT', 3.05))
+read_timeout = float(os.environ.get('JIRA_READ_TIMEOUT', 30))
+max_retries = int(os.environ.get('JIRA_MAX_RETRIES', 3))
+retry_backoff = float(os.environ.get('JIRA_RETRY_BACKOFF', 0.5))
+pool_size = int(os.environ.get('JIRA_POOL_SIZE', 10))
+
+headers = {
+   "Accept": "application/json",
+   "Content-Type": "application/json",
+   "Accept-Encoding": "gzip, deflate",
+}
+
+
+class JiraRetry(Retry):
+    """
+    Retry policy for Jira requests.
+
+    GET, PUT and DELETE are retried on 429 and 5xx responses. POST is only retried on 429,
+    because Jira rejects rate limited requests before doing any work, while a 5xx on a POST
+    may already have created the worklog.
+    """
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method.upper() == 'POST':
+            return status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class JiraClient:
+    """
+    A Jira REST client that keeps a pooled, keep-alive session for a single user credential.
+
+    Args:
+        user_email (str): The Jira user's email.
+        api_token (str): The Jira API token of the user.
+        base_url (str, optional): The Jira base URL. Defaults to JIRA_BASE_URL.
+    """
+
+    def __init__(self, user_email: str, api_token: str, base_url: str = None):
+        self.base_url = (base_url or jira_url).rstrip('/')
+        self.user_email = user_email
+        self.account_id = None
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = JiraRetry(
+            total=max_retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET', 'PUT', 'DELETE'],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(user_email, api_token)
+        self.session.headers.update(headers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Sends a request to the Jira REST API.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The API path, e.g. `/rest/api/3/myself`.
+            **kwargs: Extra arguments passed on to `requests.Session.request`.
+
+        Returns:
+            requests.Response: The response from Jira.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, f'{self.base_url}{path}', **kwargs)
+
+    def get_account_id(self) -> str:
+        """
+        Returns the Jira accountId of the user, fetching `/myself` only on first use.
+
+        Returns:
+            str: The accountId, or None if Jira could not be reached.
+        """
+        if self.account_id is None:
+            response = self.get('/rest/api/3/myself')
+            if response.status_code == 200:
+                self.account_id = response.json()['accountId']
+
+        return self.account_id
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', path, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_jira_client(auth_stuff: dict) -> JiraClient:
+    """
+    Returns the shared JiraClient for the credential in auth_stuff, creating it on first use.
+
+    Args:
+        auth_stuff (dict): A dictionary containing `user_email` and `jira_api_token`.
+
+    Returns:
+        JiraClient: The client for that credential.
+    """
+    credential = (auth_stuff['user_email'], auth_stuff['jira_api_token'])
+
+    with _clients_lock:
+        client = _clients.get(credential)
+        if client is None:
+            client = JiraClient(*credential)
+            _clients[credential] = client
+
+    return client
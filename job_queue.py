@@ -0,0 +1,299 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from dotenv import load_dotenv
+from redis.exceptions import LockError
+from redis_conn import r, ar
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# seconds a reserved job stays invisible to other workers before it's handed out again
+visibility_timeout = int(os.environ.get('JOB_VISIBILITY_TIMEOUT', 300))
+
+# how many times a job is tried before it's moved to the dead letter list
+max_attempts = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+
+# seconds to wait before the first retry, doubled for every later one
+retry_backoff = int(os.environ.get('JOB_RETRY_BACKOFF', 10))
+
+# seconds an idle worker waits before it looks at the queue again
+poll_interval = float(os.environ.get('JOB_POLL_INTERVAL', 0.5))
+
+# seconds a dedupe key keeps pointing at its job, long enough to cover Slack's retries and double clicks
+dedupe_ttl = int(os.environ.get('JOB_DEDUPE_TTL', 600))
+
+queue_key = 'jobs:queue'
+processing_key = 'jobs:processing'
+inflight_key = 'jobs:inflight'
+delayed_key = 'jobs:delayed'
+dead_key = 'jobs:dead'
+
+# job name -> function, see task
+handlers = {}
+
+# takes the next job off the queue onto the processing list, hides it until ARGV[1] and counts the
+# attempt in one step, so a worker that dies in between can't leave a job no one will requeue
+reserve_script = r.register_script("""
+local job_id = redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'LEFT')
+if not job_id then
+    return false
+end
+redis.call('ZADD', KEYS[3], ARGV[1], job_id)
+if redis.call('EXISTS', 'job:' .. job_id) == 1 then
+    redis.call('HINCRBY', 'job:' .. job_id, 'attempts', 1)
+end
+return job_id
+""")
+
+# moves jobs whose visibility timeout passed back to the queue, and delayed jobs that are due
+requeue_script = r.register_script("""
+local moved = 0
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, job_id in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('LREM', KEYS[2], 1, job_id)
+    redis.call('LPUSH', KEYS[3], job_id)
+    moved = moved + 1
+end
+local due = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, job_id in ipairs(due) do
+    redis.call('ZREM', KEYS[4], job_id)
+    redis.call('LPUSH', KEYS[3], job_id)
+    moved = moved + 1
+end
+return moved
+""")
+
+
+def task(name: str):
+    """
+    Registers a function as the handler of a job name.
+
+    Args:
+        name (str): The name jobs are enqueued with.
+
+    Returns:
+        The decorator.
+    """
+    def register(func):
+        handlers[name] = func
+        return func
+
+    return register
+
+def make_job(name: str, args: tuple) -> tuple:
+    """
+    Creates a new job ID and the job's data.
+
+    Args:
+        name (str): The name of the job's handler.
+        args (tuple): The arguments of the handler.
+
+    Returns:
+        tuple: The job ID and the job.
+    """
+    job_id = secrets.token_hex(12)
+    job = {
+        'name': name,
+        'args': json.dumps(list(args)),
+        'attempts': 0,
+        'enqueued_at': int(time.time()),
+    }
+    return job_id, job
+
+def enqueue(name: str, *args, dedupe_key: str = None, dedupe_seconds: int = None, delay: int = None) -> str:
+    """
+    Adds a job to the queue.
+
+    Args:
+        name (str): The name of the job's handler.
+        *args: The arguments of the handler. They must be JSON serializable.
+        dedupe_key (str, optional): Identifies the request the job is for. While the key is known, enqueueing
+            the same request again returns the existing job instead of adding a new one. Defaults to None.
+        dedupe_seconds (int, optional): How long the key is known for. Defaults to `JOB_DEDUPE_TTL`.
+        delay (int, optional): Seconds to wait before the job is run. Defaults to running it right away.
+
+    Returns:
+        str: The ID of the job.
+    """
+    job_id, job = make_job(name, args)
+
+    if dedupe_key is not None:
+        if not r.set(f'jobs:dedupe:{dedupe_key}', job_id, nx=True, ex=dedupe_seconds or dedupe_ttl):
+            return r.get(f'jobs:dedupe:{dedupe_key}')
+
+    pipe = r.pipeline()
+    pipe.hset(f'job:{job_id}', mapping=job)
+    if delay:
+        pipe.zadd(delayed_key, {job_id: time.time() + delay})
+    else:
+        pipe.lpush(queue_key, job_id)
+    pipe.execute()
+
+    return job_id
+
+async def enqueue_async(name: str, *args, dedupe_key: str = None) -> str:
+    """
+    Adds a job to the queue without blocking the event loop.
+
+    Args:
+        name (str): The name of the job's handler.
+        *args: The arguments of the handler. They must be JSON serializable.
+        dedupe_key (str, optional): Identifies the request the job is for, see enqueue. Defaults to None.
+
+    Returns:
+        str: The ID of the job.
+    """
+    job_id, job = make_job(name, args)
+
+    if dedupe_key is not None:
+        if not await ar.set(f'jobs:dedupe:{dedupe_key}', job_id, nx=True, ex=dedupe_ttl):
+            return await ar.get(f'jobs:dedupe:{dedupe_key}')
+
+    pipe = ar.pipeline()
+    pipe.hset(f'job:{job_id}', mapping=job)
+    pipe.lpush(queue_key, job_id)
+    await pipe.execute()
+
+    return job_id
+
+def reserve(timeout: int = 5) -> tuple:
+    """
+    Takes the next job off the queue and hides it from other workers until it's acked or its visibility timeout passes.
+
+    The queue is checked every `JOB_POLL_INTERVAL` seconds, a blocking move couldn't hide the job in the same step.
+
+    Args:
+        timeout (int, optional): Seconds to wait for a job. Defaults to 5.
+
+    Returns:
+        tuple: The job ID and the job, or `(None, None)` if no job came in.
+    """
+    deadline = time.time() + timeout
+
+    while True:
+        job_id = reserve_script(keys=[queue_key, processing_key, inflight_key], args=[time.time() + visibility_timeout])
+        if job_id is not None:
+            break
+        if time.time() >= deadline:
+            return None, None
+        time.sleep(poll_interval)
+
+    job = r.hgetall(f'job:{job_id}')
+
+    if not job:
+        # the job's data is gone, there is nothing to run
+        ack(job_id)
+        return None, None
+
+    return job_id, job
+
+def touch(job_id: str) -> None:
+    """
+    Extends the visibility timeout of a job that is still running.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        None
+    """
+    r.zadd(inflight_key, {job_id: time.time() + visibility_timeout}, xx=True)
+
+def keep_lock(lock, done: threading.Event) -> None:
+    """
+    Keeps resetting a lock's timeout while the job holding it is still running, the way the worker
+    extends the job's visibility timeout.
+
+    Args:
+        lock: The acquired redis lock. It needs a timeout and `thread_local=False`, so this thread can extend it.
+        done (threading.Event): Set when the job is done with the lock.
+
+    Returns:
+        None
+    """
+    while not done.wait(lock.timeout / 3):
+        try:
+            lock.reacquire()
+        except LockError:
+            logger.warning(f'Lost lock {lock.name} before the job holding it was done.')
+            return
+
+def ack(job_id: str) -> None:
+    """
+    Marks a job as done and removes it.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        None
+    """
+    pipe = r.pipeline()
+    pipe.lrem(processing_key, 1, job_id)
+    pipe.zrem(inflight_key, job_id)
+    pipe.delete(f'job:{job_id}')
+    pipe.execute()
+
+def fail(job_id: str, job: dict, error: str) -> None:
+    """
+    Schedules a failed job for a retry with exponential backoff, or moves it to the dead letter list after `JOB_MAX_ATTEMPTS` tries.
+
+    Args:
+        job_id (str): The ID of the job.
+        job (dict): The job.
+        error (str): What went wrong.
+
+    Returns:
+        None
+    """
+    attempts = int(job['attempts'])
+
+    pipe = r.pipeline()
+    pipe.lrem(processing_key, 1, job_id)
+    pipe.zrem(inflight_key, job_id)
+    pipe.hset(f'job:{job_id}', 'last_error', error)
+
+    if attempts < max_attempts:
+        pipe.zadd(delayed_key, {job_id: time.time() + retry_backoff * 2 ** (attempts - 1)})
+        logger.warning(f"Job {job_id} ({job['name']}) failed on attempt {attempts}, retrying.")
+    else:
+        pipe.lpush(dead_key, job_id)
+        logger.error(f"Job {job_id} ({job['name']}) failed {attempts} times, giving up.")
+
+    pipe.execute()
+
+def requeue_expired(limit: int = 100) -> int:
+    """
+    Puts jobs whose worker died, or whose retry is due, back on the queue.
+
+    Args:
+        limit (int, optional): The max number of jobs of each kind to move. Defaults to 100.
+
+    Returns:
+        int: The number of jobs moved.
+    """
+    return requeue_script(keys=[inflight_key, processing_key, queue_key, delayed_key], args=[time.time(), limit])
+
+def run_job(job: dict) -> None:
+    """
+    Runs a job's handler. Coroutine handlers are run on a fresh event loop.
+
+    Args:
+        job (dict): The job.
+
+    Returns:
+        None
+    """
+    handler = handlers[job['name']]
+    result = handler(*json.loads(job['args']))
+
+    if inspect.iscoroutine(result):
+        asyncio.run(result)
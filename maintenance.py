@@ -0,0 +1,430 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from redis.exceptions import LockError, WatchError
+from redis_conn import r
+from event_store import decode_event, encode_event, encode_worklog, expire_events, delete_orphan_events, delete_orphan_worklogs
+from gcal import sync_past_days
+import issue_store
+import worklog_store
+from utils import backfill_team_users, get_slack_client
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# days a calendar event without a worklog is kept after the day it starts on. At least GCAL_SYNC_PAST_DAYS,
+# or every full calendar sync would fetch the events that were just deleted again
+unlogged_event_retention_days = int(os.environ.get('UNLOGGED_EVENT_RETENTION_DAYS', sync_past_days))
+
+# days a calendar event logged to jira, and its worklog, are kept after the day it starts on. The logged time reports read them
+logged_event_retention_days = int(os.environ.get('LOGGED_EVENT_RETENTION_DAYS', 400))
+
+# seconds between garbage collection runs scheduled by the workers
+gc_interval = int(os.environ.get('GC_INTERVAL', 3600))
+
+# keys checked per round trip during garbage collection
+gc_batch_size = int(os.environ.get('GC_BATCH_SIZE', 500))
+
+# deletes a cached copy (KEYS) if the timestamp in field ARGV[1] of its first key is missing or older than ARGV[2]
+delete_stale_script = r.register_script("""
+local stamp = tonumber(redis.call('HGET', KEYS[1], ARGV[1]))
+if stamp and stamp >= tonumber(ARGV[2]) then
+    return 0
+end
+return redis.call('DEL', unpack(KEYS))
+""")
+
+
+def in_batches(keys, batch_size: int):
+    """
+    Groups keys, as they come from a SCAN, into lists.
+
+    Args:
+        keys: The keys.
+        batch_size (int): The size of each list.
+
+    Yields:
+        list: The next batch of keys.
+    """
+    batch = []
+
+    for key in keys:
+        batch.append(key)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def memory_usage(keys: list) -> list:
+    """
+    Reads the bytes keys take in Redis in one pipelined round trip.
+
+    Args:
+        keys (list): The keys.
+
+    Returns:
+        list: The bytes of each key, in the same order, 0 for keys that don't exist.
+    """
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+
+    return [size or 0 for size in pipe.execute()]
+
+def event_sizes(event_ids: list) -> list:
+    """
+    Reads the bytes calendar events and their worklogs take in Redis in two pipelined round trips.
+
+    Args:
+        event_ids (list): The IDs of the events.
+
+    Returns:
+        list: The bytes of each event together with its worklog, in the same order.
+    """
+    pipe = r.pipeline(transaction=False)
+    for event_id in event_ids:
+        pipe.memory_usage(f'calEvent:{event_id}')
+        pipe.hget(f'calEvent:{event_id}', 'jira_worklog_id')
+    results = pipe.execute()
+
+    worklog_ids = [worklog_id for worklog_id in results[1::2] if worklog_id]
+    worklog_sizes = dict(zip(worklog_ids, memory_usage([f'worklog:{worklog_id}' for worklog_id in worklog_ids])))
+
+    return [(size or 0) + worklog_sizes.get(worklog_id, 0) for size, worklog_id in zip(results[0::2], results[1::2])]
+
+def convert_event(key: str, fields: dict) -> dict:
+    """
+    Converts a `calEvent:*` hash stored before the schema was versioned into the current layout.
+
+    Args:
+        key (str): The key of the hash.
+        fields (dict): The stored fields.
+
+    Returns:
+        dict: The fields to store, or None if the event can't be converted.
+    """
+    event = decode_event(key.split(':', 1)[1], fields)
+    if not event.get('start') or event.get('duration') is None:
+        return None
+
+    return encode_event(event)
+
+def convert_worklog(key: str, fields: dict) -> dict:
+    """
+    Converts a `worklog:*` hash stored before the schema was versioned, which held every field jira
+    returned as JSON, into the current layout.
+
+    Args:
+        key (str): The key of the hash.
+        fields (dict): The stored fields.
+
+    Returns:
+        dict: The fields to store, or None if the worklog can't be converted.
+    """
+    worklog = {field: json.loads(value) for field, value in fields.items() if field != 'event_id'}
+    if not all(field in worklog for field in ('issueId', 'started', 'timeSpentSeconds', 'updated')):
+        return None
+
+    return encode_worklog(worklog, fields.get('event_id'))
+
+def migrate_batch(keys: list, convert, dry_run: bool) -> tuple:
+    """
+    Converts a batch of hashes to the current layout in one transaction.
+
+    The keys are watched while they're converted, so a hash that changes in the meantime makes the
+    batch start over instead of being overwritten.
+
+    Args:
+        keys (list): The keys of the hashes.
+        convert (callable): Turns the key and stored fields of a hash in the old layout into the fields to store.
+        dry_run (bool): Only count what would be converted.
+
+    Returns:
+        tuple: The number of hashes converted, the number that couldn't be, and their size in bytes before and after.
+    """
+    while True:
+        with r.pipeline() as pipe:
+            try:
+                pipe.watch(*keys)
+
+                reads = r.pipeline(transaction=False)
+                for key in keys:
+                    reads.hgetall(key)
+                    reads.memory_usage(key)
+                results = reads.execute()
+
+                converted = {}
+                failed = 0
+                bytes_before = 0
+                for key, fields, size in zip(keys, results[0::2], results[1::2]):
+                    if not fields or 'v' in fields:
+                        continue
+
+                    new_fields = convert(key, fields)
+                    if new_fields is None:
+                        logger.warning(f"Couldn't convert {key}, leaving it as it is.")
+                        failed += 1
+                        continue
+
+                    converted[key] = new_fields
+                    bytes_before += size or 0
+
+                if dry_run or not converted:
+                    pipe.reset()
+                    return len(converted), failed, bytes_before, bytes_before
+
+                pipe.multi()
+                for key, new_fields in converted.items():
+                    pipe.delete(key)
+                    pipe.hset(key, mapping=new_fields)
+                pipe.execute()
+            except WatchError:
+                continue
+
+        return len(converted), failed, bytes_before, sum(memory_usage(list(converted)))
+
+def migrate(batch_size: int = 500, dry_run: bool = False) -> dict:
+    """
+    Converts the `calEvent:*` and `worklog:*` hashes stored before the schema was versioned to the current layout.
+
+    The keys are scanned and converted in batches, so Redis is never held for more than one batch.
+    Hashes already in the current layout are left alone, so the migration can be run again safely.
+
+    Args:
+        batch_size (int, optional): The number of keys scanned and converted at a time. Defaults to 500.
+        dry_run (bool, optional): Only count what would be converted. Defaults to False.
+
+    Returns:
+        dict: Per key pattern, the number of hashes converted and failed and their size in bytes before and after.
+    """
+    report = {}
+
+    for pattern, convert in (('calEvent:*', convert_event), ('worklog:*', convert_worklog)):
+        totals = [0, 0, 0, 0]
+
+        for batch in in_batches(r.scan_iter(match=pattern, count=batch_size, _type='hash'), batch_size):
+            totals = [total + value for total, value in zip(totals, migrate_batch(batch, convert, dry_run))]
+
+        report[pattern] = dict(zip(('converted', 'failed', 'bytes_before', 'bytes_after'), totals))
+        logger.info(f'Migrated {pattern}: {report[pattern]}')
+
+    return report
+
+def expire_user_events(index_key: str, unlogged_before: int, logged_before: int, batch_size: int) -> tuple:
+    """
+    Deletes the calendar events in a user's date index that are past their retention, and the index
+    entries of events that are gone.
+
+    An incremental calendar sync only brings changes, so it would never bring back an expired event
+    that's still inside the user's synced window. If one is expired, the sync state is dropped and the
+    next sync is a full one.
+
+    Args:
+        index_key (str): The `user:{id}:calEvents` key of the user.
+        unlogged_before (int): Events without a worklog that start before this day (YYYYMMDD) are deleted.
+        logged_before (int): Events with a worklog that start before this day (YYYYMMDD) are deleted.
+        batch_size (int): The number of events checked per round trip.
+
+    Returns:
+        tuple: The number of events deleted, the number of index entries dropped and the bytes reclaimed.
+    """
+    user_id = index_key.split(':')[1]
+    expired = dangling = reclaimed = 0
+    expired_in_window = False
+
+    window_start = r.hget(f'user:{user_id}:gcalSync', 'window_start')
+    window_day = int(datetime.datetime.fromisoformat(window_start).strftime('%Y%m%d')) if window_start else None
+
+    index_size = r.memory_usage(index_key) or 0
+
+    for batch in in_batches(r.zscan_iter(index_key, count=batch_size), batch_size):
+        event_ids = [event_id for event_id, _ in batch]
+        days = dict(batch)
+
+        # only events old enough to be deleted are worth measuring
+        old_event_ids = [event_id for event_id, day in batch if day < unlogged_before]
+        sizes = dict(zip(old_event_ids, event_sizes(old_event_ids)))
+
+        for event_id, result in zip(event_ids, expire_events(user_id, event_ids, unlogged_before, logged_before)):
+            if result == 'expired':
+                expired += 1
+                reclaimed += sizes.get(event_id, 0)
+                expired_in_window = expired_in_window or (window_day is not None and days[event_id] >= window_day)
+            elif result == 'dangling':
+                dangling += 1
+
+    if expired or dangling:
+        reclaimed += max(index_size - (r.memory_usage(index_key) or 0), 0)
+
+    if expired_in_window:
+        r.delete(f'user:{user_id}:gcalSync')
+        logger.info(f'Expired events inside the synced calendar window of user {user_id}, the next sync is a full one.')
+
+    return expired, dangling, reclaimed
+
+def collect_garbage(batch_size: int = gc_batch_size) -> dict:
+    """
+    Deletes what the app no longer reads from Redis, a batch at a time so Redis is never held for long.
+
+    - Calendar events without a worklog `UNLOGGED_EVENT_RETENTION_DAYS` after they started, and
+      events with one `LOGGED_EVENT_RETENTION_DAYS` after, along with their worklogs.
+    - Entries in the users' date indexes whose event is gone.
+    - Calendar events missing from their user's date index, and worklogs whose event is gone.
+    - Copies of an issue's worklogs and of a user's open issues that are old enough to be fetched
+      again in full, and the worklog index's deletion records that no copy can still need.
+
+    Every key is checked again when it's deleted, so anything that changed in the meantime is kept.
+    Only one run happens at a time across all workers.
+
+    Args:
+        batch_size (int, optional): The number of keys checked per round trip. Defaults to `GC_BATCH_SIZE`.
+
+    Returns:
+        dict: The number of keys or entries removed per kind, and the bytes reclaimed. Empty if another run holds the lock.
+
+    Raises:
+        ValueError: If `UNLOGGED_EVENT_RETENTION_DAYS` is shorter than `GCAL_SYNC_PAST_DAYS`.
+    """
+    if unlogged_event_retention_days < sync_past_days:
+        raise ValueError(f'UNLOGGED_EVENT_RETENTION_DAYS ({unlogged_event_retention_days}) is shorter than GCAL_SYNC_PAST_DAYS ({sync_past_days}), events inside the synced calendar window would be deleted.')
+
+    lock = r.lock('lock:maintenance:gc', timeout=gc_interval)
+    if not lock.acquire(blocking=False):
+        logger.info('Garbage collection is already running.')
+        return {}
+
+    try:
+        report = dict.fromkeys(['expired_events', 'dangling_index_entries', 'orphan_events', 'orphan_worklogs', 'stale_issue_worklogs', 'stale_open_issues', 'deletion_records'], 0)
+        reclaimed = 0
+
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        unlogged_before = int((today - datetime.timedelta(days=unlogged_event_retention_days)).strftime('%Y%m%d'))
+        logged_before = int((today - datetime.timedelta(days=logged_event_retention_days)).strftime('%Y%m%d'))
+
+        for index_key in r.scan_iter(match='user:*:calEvents', count=batch_size, _type='zset'):
+            expired, dangling, size = expire_user_events(index_key, unlogged_before, logged_before, batch_size)
+            report['expired_events'] += expired
+            report['dangling_index_entries'] += dangling
+            reclaimed += size
+
+        for batch in in_batches(r.scan_iter(match='calEvent:*', count=batch_size, _type='hash'), batch_size):
+            event_ids = [key.split(':', 1)[1] for key in batch]
+            sizes = event_sizes(event_ids)
+            for size, deleted in zip(sizes, delete_orphan_events(event_ids)):
+                report['orphan_events'] += deleted
+                reclaimed += size if deleted else 0
+
+        for batch in in_batches(r.scan_iter(match='worklog:*', count=batch_size, _type='hash'), batch_size):
+            sizes = memory_usage(batch)
+            for size, deleted in zip(sizes, delete_orphan_worklogs([key.split(':', 1)[1] for key in batch])):
+                report['orphan_worklogs'] += deleted
+                reclaimed += size if deleted else 0
+
+        now = time.time()
+        caches = (
+            # issue copies are synced in epoch milliseconds, open issue copies in seconds
+            ('stale_issue_worklogs', 'issue:*:worklogs_meta', '_meta', 'synced_at', int((now - worklog_store.max_incremental_age) * 1000)),
+            ('stale_open_issues', 'jira:open_issues:*:meta', ':meta', 'filled_at', int(now - issue_store.max_incremental_age)),
+        )
+        for kind, pattern, suffix, field, before in caches:
+            for batch in in_batches(r.scan_iter(match=pattern, count=batch_size, _type='hash'), batch_size):
+                copies = [[meta_key, meta_key[:-len(suffix)]] for meta_key in batch]
+                sizes = memory_usage([key for copy in copies for key in copy])
+
+                pipe = r.pipeline(transaction=False)
+                for copy in copies:
+                    delete_stale_script(keys=copy, args=[field, before], client=pipe)
+
+                for index, deleted in enumerate(pipe.execute()):
+                    if deleted:
+                        report[kind] += 1
+                        reclaimed += sizes[index * 2] + sizes[index * 2 + 1]
+
+        # a copy is only caught up from the index if it was synced within max_incremental_age, so older deletions are never read
+        deleted_before = int((now - worklog_store.max_incremental_age) * 1000)
+        for batch in in_batches(r.scan_iter(match=f'{worklog_store.index_key}:issue:*:deleted', count=batch_size, _type='zset'), batch_size):
+            pipe = r.pipeline(transaction=False)
+            for key in batch:
+                pipe.memory_usage(key)
+                pipe.zremrangebyscore(key, '-inf', f'({deleted_before}')
+                pipe.memory_usage(key)
+            results = pipe.execute()
+
+            for before, removed, after in zip(results[0::3], results[1::3], results[2::3]):
+                report['deletion_records'] += removed
+                reclaimed += max((before or 0) - (after or 0), 0) if removed else 0
+
+        report['bytes'] = reclaimed
+        logger.info(f'Collected garbage: {report}')
+
+        return report
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # the run took longer than the lock's timeout, it's already gone
+            pass
+
+def backfill_teams() -> dict:
+    """
+    Fills in `team:{id}:users` of every installed team from its Slack members, for teams that used
+    the app before users were recorded per team. Running it again only adds users that are missing.
+
+    Returns:
+        dict: The number of users added per team ID.
+    """
+    report = {}
+
+    for key in r.scan_iter(match='team:*:slack_access_token', count=gc_batch_size):
+        team_id = key.split(':')[1]
+        report[team_id] = backfill_team_users(team_id, get_slack_client(r.get(key)))
+        logger.info(f'Added {report[team_id]} users to team {team_id}.')
+
+    return report
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', filename='maintenance.log')
+
+    parser = argparse.ArgumentParser(description='Maintenance tasks for the data the app keeps in Redis.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = commands.add_parser('migrate', help='Convert calendar events and worklogs stored in the old layout to the current one.')
+    migrate_parser.add_argument('--batch', type=int, default=500, help='Keys scanned and converted at a time.')
+    migrate_parser.add_argument('--dry-run', action='store_true', help="Only report what would be converted.")
+
+    gc_parser = commands.add_parser('gc', help='Delete calendar events, worklogs and cached copies that are past their retention or orphaned.')
+    gc_parser.add_argument('--batch', type=int, default=gc_batch_size, help='Keys checked per round trip.')
+
+    commands.add_parser('backfill-team-users', help="Record which authorized users belong to each team, for the team's logged time report.")
+
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        for pattern, counts in migrate(args.batch, args.dry_run).items():
+            verb = 'Would convert' if args.dry_run else 'Converted'
+            saved = f", {counts['bytes_before']} bytes before" if args.dry_run else f", {counts['bytes_before']} -> {counts['bytes_after']} bytes"
+            print(f"{pattern}: {verb} {counts['converted']} hashes, {counts['failed']} couldn't be converted{saved}.")
+
+    if args.command == 'gc':
+        try:
+            report = collect_garbage(args.batch)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        if not report:
+            raise SystemExit('Garbage collection is already running.')
+
+        reclaimed = report.pop('bytes')
+        for kind, removed in report.items():
+            print(f"{kind.replace('_', ' ').capitalize()}: {removed} removed.")
+        print(f'Reclaimed {reclaimed} bytes.')
+
+    if args.command == 'backfill-team-users':
+        for team_id, added in backfill_teams().items():
+            print(f'{team_id}: added {added} users.')
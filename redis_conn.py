@@ -1,4 +1,5 @@
 import redis
+import redis.asyncio
 import os
 from dotenv import load_dotenv
 
@@ -16,3 +17,11 @@ r = redis.Redis(
   password=redis_password,
   decode_responses=True
 )
+
+# asyncio client for code running on the web server's event loop
+ar = redis.asyncio.Redis(
+  host=host,
+  port=rport,
+  password=redis_password,
+  decode_responses=True
+)
@@ -0,0 +1,178 @@
+import json
+import os
+import secrets
+import threading
+import urllib.parse
+from dotenv import load_dotenv
+from redis.exceptions import LockError
+from gcal import get_events_gcal
+from jira import create_worklog, get_issue_worklogs, delete_worklog_by_id, get_jira_issues_for_user
+from job_queue import task, enqueue, keep_lock, visibility_timeout
+from redis_conn import r
+import gcal_credentials
+import maintenance
+import worklog_indexer
+from utils import get_slack_client, get_capacity_from_redis, get_team_logged_time, open_dm_channel, create_authorize_me_button
+
+load_dotenv()
+
+google_client_id = os.environ.get('GOOGLE_CLIENT_ID')
+google_client_secret = os.environ.get('GOOGLE_CLIENT_SECRET')
+google_token_url = os.environ.get('GOOGLE_TOKEN_URI')
+google_redirect_uri = os.environ.get('GOOGLE_REDIRECT_URI')
+google_auth_base_url = os.environ.get('GOOGLE_AUTH_BASE_URL')
+
+# seconds a confirmation waits before it's tried again while the user's previous one is still being logged
+log_worklogs_retry_delay = int(os.environ.get('LOG_WORKLOGS_RETRY_DELAY', 30))
+
+
+def get_team_client(team_id: str):
+    """
+    Returns the Slack WebClient of a team.
+
+    Args:
+        team_id (str): The ID of the team.
+
+    Returns:
+        slack.WebClient: The team's WebClient.
+    """
+    return get_slack_client(r.get(f'team:{team_id}:slack_access_token'))
+
+def get_user_context(team_id: str, user_id: str) -> tuple:
+    """
+    Looks up what a job needs to talk to a user: the team's Slack client, the user's DM channel and their auth stuff.
+
+    Args:
+        team_id (str): The ID of the team.
+        user_id (str): The ID of the user.
+
+    Returns:
+        tuple: The WebClient, the DM channel ID and the auth stuff JSON, or `None` for the auth stuff if the user hasn't run `/setup` yet.
+    """
+    pipe = r.pipeline()
+    pipe.get(f'team:{team_id}:slack_access_token')
+    pipe.get(f'user:{user_id}')
+    pipe.sadd(f'team:{team_id}:users', user_id)
+    slack_token, auth_stuff, _ = pipe.execute()
+
+    client = get_slack_client(slack_token)
+    channel_id = open_dm_channel(user_id, slack_token)
+
+    if auth_stuff is None:
+        # Send a message to the user
+        client.chat_postMessage(channel=channel_id, text=f"You haven't authorized me yet. Try running `/setup`")
+
+    return client, channel_id, auth_stuff
+
+@task('list_events')
+async def list_events(team_id: str, user_id: str, text: list) -> None:
+    client, channel_id, auth_stuff = get_user_context(team_id, user_id)
+    if auth_stuff is not None:
+        await get_events_gcal(user_id, google_token_url, google_client_id, google_client_secret, text, auth_stuff, client, channel_id)
+
+@task('log_worklogs')
+def log_worklogs(team_id: str, user_id: str, event_ids: list, waiting: bool = False) -> None:
+    client, channel_id, auth_stuff = get_user_context(team_id, user_id)
+    if auth_stuff is None:
+        return
+
+    # only one run per user at a time, a second one would post the same worklogs again. The lock
+    # is extended while the run lasts and expires with the job's visibility timeout if the worker dies
+    lock = r.lock(f'lock:user:{user_id}:worklogs', timeout=visibility_timeout, thread_local=False)
+    if not lock.acquire(blocking=False):
+        # duplicates of the running confirmation are already dropped when they're enqueued, so this is another one
+        if not waiting:
+            client.chat_postMessage(channel=channel_id, text=f"I'm still logging your previous worklogs, I'll log these as soon as that's done.")
+        enqueue('log_worklogs', team_id, user_id, event_ids, True, delay=log_worklogs_retry_delay)
+        return
+
+    done = threading.Event()
+    threading.Thread(target=keep_lock, args=(lock, done), daemon=True).start()
+
+    try:
+        create_worklog(event_ids, user_id, client, channel_id)
+    finally:
+        done.set()
+        try:
+            lock.release()
+        except LockError:
+            # the lock expired while the run was stuck, it's already gone
+            pass
+
+@task('get_worklogs')
+def get_worklogs(team_id: str, user_id: str, issue_key: str) -> None:
+    client, channel_id, auth_stuff = get_user_context(team_id, user_id)
+    if auth_stuff is not None:
+        get_issue_worklogs(issue_key, auth_stuff, channel_id, client, user_id)
+
+@task('delete_worklog')
+def delete_worklog(team_id: str, user_id: str, text: list) -> None:
+    client, channel_id, auth_stuff = get_user_context(team_id, user_id)
+    if auth_stuff is not None:
+        delete_worklog_by_id(text, user_id, client, channel_id, auth_stuff)
+
+@task('get_open_issues')
+def get_open_issues(team_id: str, user_id: str) -> None:
+    client, channel_id, auth_stuff = get_user_context(team_id, user_id)
+    if auth_stuff is not None:
+        get_jira_issues_for_user(auth_stuff, client, channel_id)
+
+@task('show_logged_time')
+def show_logged_time(team_id: str, user_id: str, text: list) -> None:
+    client, channel_id, auth_stuff = get_user_context(team_id, user_id)
+    if auth_stuff is not None:
+        get_capacity_from_redis(user_id, client, channel_id, auth_stuff, text)
+
+@task('team_logged_time')
+def team_logged_time(team_id: str, user_id: str, text: list) -> None:
+    client, channel_id, auth_stuff = get_user_context(team_id, user_id)
+    if auth_stuff is not None:
+        get_team_logged_time(team_id, user_id, client, channel_id, auth_stuff, text)
+
+@task('index_worklogs')
+def index_worklogs() -> None:
+    worklog_indexer.run_indexer()
+
+@task('refresh_google_tokens')
+def refresh_google_tokens() -> None:
+    gcal_credentials.refresh_expiring_tokens()
+
+@task('collect_garbage')
+def collect_garbage() -> None:
+    maintenance.collect_garbage()
+
+@task('setup')
+def setup(team_id: str, user_id: str, jira_api_token: str) -> None:
+    slack_token = r.get(f'team:{team_id}:slack_access_token')
+    r.sadd(f'team:{team_id}:users', user_id)
+    channel_id = open_dm_channel(user_id, slack_token)
+
+    # Generate a secure, random state value
+    random_state = secrets.token_urlsafe()
+    state = {"state":random_state,"channel":channel_id,"user":user_id, "jira_api_token": jira_api_token, "slack_token": slack_token}
+    encoded_state = urllib.parse.quote(json.dumps(state))
+
+    # Set scopes to include in the authorization request
+    scopes = ['https://www.googleapis.com/auth/calendar.readonly', 'https://www.googleapis.com/auth/userinfo.email']
+
+    # Make a list of scopes into a string
+    scopes_string = ' '.join(scopes)
+
+    # Construct the full URL
+    params = {
+        'client_id': google_client_id,
+        'redirect_uri': google_redirect_uri,
+        'response_type': 'code',
+        'scope': scopes_string,
+        'state': encoded_state,
+        'access_type': 'offline', # If you need a refresh token
+        'include_granted_scopes': 'true', # To request incremental authorization
+        'prompt': 'consent' # To always prompt the user for authorization
+    }
+
+    auth_url = google_auth_base_url + '?' + urllib.parse.urlencode(params)
+
+    message = create_authorize_me_button(auth_url)
+
+    # Send the user a link to the Google Auth page
+    get_slack_client(slack_token).chat_postMessage(channel=channel_id, blocks=message)
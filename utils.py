@@ -2,17 +2,58 @@ import re
 from tabulate import tabulate
 import datetime
 import slack
-import requests
+import aiohttp
 import pytz
 from dateutil import parser
+from dateutil.relativedelta import relativedelta
 import os
 from dotenv import load_dotenv
 import textwrap
-from redis_conn import r
+from redis_conn import r, ar
+from event_store import load_daily_seconds, load_users_daily_seconds
 import json
+import logging
+import threading
+import requests
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from slack.errors import SlackApiError
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# seconds a user's timezone is trusted before it is looked up in slack again
+timezone_ttl = int(os.environ.get('SLACK_TIMEZONE_TTL', 86400))
+
+# process-local cache of user_id -> timezone name
+timezone_cache = TTLCache(maxsize=1024, ttl=min(timezone_ttl, 3600))
+timezone_cache_lock = threading.Lock()
+
+# slack access token -> WebClient, one per team
+slack_clients = {}
+slack_clients_lock = threading.Lock()
+
+# process-local cache of user_id -> DM channel ID
+dm_channel_cache = {}
+
+# slack user IDs, comma separated, that may see the team report besides the workspace's admins and owners
+team_report_users = set(user_id.strip() for user_id in os.environ.get('TEAM_REPORT_USERS', '').split(',') if user_id.strip())
+
+# threads and users per pipeline used to read a team's logged time
+team_report_workers = int(os.environ.get('TEAM_REPORT_WORKERS', 8))
+team_report_chunk_size = int(os.environ.get('TEAM_REPORT_CHUNK_SIZE', 25))
+
+# clients used on the event loop, see get_http_session and get_async_slack_client
+http_session = None
+async_slack_clients = {}
+
+# slack limits a section's text to 3000 characters and a message to 50 blocks
+max_section_chars = 3000
+max_message_blocks = 50
+max_message_chars = int(os.environ.get('SLACK_MAX_MESSAGE_CHARS', 12000))
+max_listing_messages = int(os.environ.get('SLACK_LISTING_MAX_MESSAGES', 3))
+
 def find_pattern(text: str) -> str:
     """
     Finds the first occurrence of a pattern in the given text.
@@ -71,9 +112,9 @@ def make_tabular(events: list, client: slack.WebClient, user_id: str, table_form
         str: The tabular representation of the events.
     """
     table = []
+    tz = get_user_timezone(user_id, client)
     for event in events:
         #convert start and end to local time
-        tz = get_user_timezone(user_id, client)
         start = make_date_friendly(event['start_str'], tz)
         end = make_date_friendly(event['end'], tz)
         table.append([
@@ -126,9 +167,141 @@ def setup_simple_text_slack_message(message: str) -> list:
     return message_payload
 
 def send_slack_message(message: list, channel_id: str, slack_token: str) -> None:
-    client = slack.WebClient(token=slack_token)
+    client = get_slack_client(slack_token)
     client.chat_postMessage(channel=channel_id, blocks=message)
 
+def build_code_sections(label: str, content: str) -> list:
+    """
+    Builds section blocks that show content in a code block under a label.
+
+    Content that does not fit in one section is split on line boundaries into several sections.
+
+    Args:
+        label (str): The text shown above the code block.
+        content (str): The content of the code block, e.g. a table.
+
+    Returns:
+        list: The section blocks.
+    """
+    # leave room for the label and the code fences
+    max_chunk = max_section_chars - len(label) - 10
+
+    chunks = []
+    chunk = ''
+    for line in content.splitlines():
+        if chunk and len(chunk) + len(line) + 1 > max_chunk:
+            chunks.append(chunk)
+            chunk = ''
+        chunk = f'{chunk}\n{line}' if chunk else line[:max_chunk]
+    chunks.append(chunk)
+
+    sections = []
+    for i, chunk in enumerate(chunks):
+        text = f"```{chunk}```"
+        if i == 0:
+            text = f"{label}\n{text}"
+        sections.extend(setup_simple_text_slack_message(text))
+
+    return sections
+
+def build_listing_messages(header: str, sections: list, footer: list = None) -> list:
+    """
+    Packs a header, labelled code sections and optional footer blocks into as few Slack messages as possible.
+
+    Args:
+        header (str): The text shown at the top of the first message.
+        sections (list): A list of `(label, content)` tuples.
+        footer (list, optional): Blocks appended to the last message, e.g. confirmation buttons.
+
+    Returns:
+        list: One list of blocks per message.
+    """
+    blocks = setup_simple_text_slack_message(header)
+    for label, content in sections:
+        blocks.extend(build_code_sections(label, content))
+    blocks.extend(footer or [])
+
+    messages = []
+    message = []
+    message_chars = 0
+    for block in blocks:
+        block_chars = len(json.dumps(block))
+        if message and (len(message) == max_message_blocks or message_chars + block_chars > max_message_chars):
+            messages.append(message)
+            message = []
+            message_chars = 0
+        message.append(block)
+        message_chars += block_chars
+    messages.append(message)
+
+    return messages
+
+def post_listing(client: slack.WebClient, channel_id: str, header: str, sections: list, footer: list = None, filename: str = 'listing.txt') -> None:
+    """
+    Posts a listing as one Block Kit message, or a few when it does not fit in one.
+
+    Listings that would need more than `SLACK_LISTING_MAX_MESSAGES` messages are uploaded as a single
+    text snippet instead, followed by the footer blocks. If the upload fails they're posted as messages after all.
+
+    Args:
+        client (slack.WebClient): The Slack WebClient instance.
+        channel_id (str): The ID of the Slack channel to post to.
+        header (str): The text shown at the top of the listing.
+        sections (list): A list of `(label, content)` tuples.
+        footer (list, optional): Blocks posted after the listing, e.g. confirmation buttons.
+        filename (str, optional): The name of the snippet when the listing is uploaded as a file.
+
+    Returns:
+        None
+    """
+    messages = build_listing_messages(header, sections, footer)
+
+    if len(messages) > max_listing_messages:
+        content = '\n\n'.join(f'{label}\n{body}' for label, body in sections)
+        try:
+            upload_snippet(client, channel_id, content, filename, header)
+        except (SlackApiError, requests.RequestException):
+            # still get the listing and its buttons to the user, just in more messages
+            logger.exception(f'Failed to upload {filename}, posting it as {len(messages)} messages instead.')
+        else:
+            if footer:
+                client.chat_postMessage(channel=channel_id, text=header, blocks=footer)
+            return
+
+    for blocks in messages:
+        client.chat_postMessage(channel=channel_id, text=header, blocks=blocks)
+
+def upload_snippet(client: slack.WebClient, channel_id: str, content: str, filename: str, initial_comment: str) -> None:
+    """
+    Shares a text file in a channel with Slack's external upload flow, which replaced `files.upload`.
+
+    Args:
+        client (slack.WebClient): The Slack WebClient instance.
+        channel_id (str): The ID of the Slack channel to share the file in.
+        content (str): The text of the file.
+        filename (str): The name of the file.
+        initial_comment (str): The message posted with the file.
+
+    Returns:
+        None
+
+    Raises:
+        SlackApiError: If slack rejects the upload.
+        requests.RequestException: If the file can't be sent to the upload URL.
+    """
+    data = content.encode()
+
+    upload = client.api_call('files.getUploadURLExternal', http_verb='GET', params={'filename': filename, 'length': len(data)})
+
+    response = requests.post(upload['upload_url'], data=data, timeout=30)
+    response.raise_for_status()
+
+    client.api_call('files.completeUploadExternal', json={
+        'files': [{'id': upload['file_id'], 'title': filename}],
+        'channel_id': channel_id,
+        'initial_comment': initial_comment,
+    })
+
 def send_confirmation_slack_message(event_ids: list) -> list:
     """
     Sends a confirmation Slack message with buttons to update JIRA worklogs.
@@ -179,10 +352,31 @@ def send_confirmation_slack_message(event_ids: list) -> list:
 
     return message_payload
 
+def get_slack_client(slack_token: str) -> slack.WebClient:
+    """
+    Returns the long-lived Slack WebClient for a team's access token, creating it on first use.
+
+    Args:
+        slack_token (str): The Slack API token stored in `team:{id}:slack_access_token`.
+
+    Returns:
+        slack.WebClient: The WebClient for that token.
+    """
+    with slack_clients_lock:
+        client = slack_clients.get(slack_token)
+        if client is None:
+            client = slack.WebClient(token=slack_token)
+            slack_clients[slack_token] = client
+
+    return client
+
 def open_dm_channel(user_id: str, slack_token: str) -> str:
     """
     Opens a direct message channel with a user on Slack.
 
+    The channel ID of a DM never changes, so it is cached in the process and in Redis and
+    `conversations.open` is only called the first time.
+
     Args:
         user_id (str): The ID of the user to open the channel with.
         slack_token (str): The Slack API token.
@@ -190,13 +384,84 @@ def open_dm_channel(user_id: str, slack_token: str) -> str:
     Returns:
         str: The ID of the opened channel.
     """
-    client = slack.WebClient(token=slack_token)
-    response = client.conversations_open(users=user_id)
-    channel_id = response['channel']['id']
+    channel_id = dm_channel_cache.get(user_id)
+    if channel_id is not None:
+        return channel_id
+
+    channel_id = r.get(f'user:{user_id}:dm_channel')
+
+    if channel_id is None:
+        client = get_slack_client(slack_token)
+        response = client.conversations_open(users=user_id)
+        channel_id = response['channel']['id']
+        r.set(f'user:{user_id}:dm_channel', channel_id)
+
+    dm_channel_cache[user_id] = channel_id
+
+    return channel_id
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Returns the aiohttp session shared by everything running on the event loop, creating it on first use.
+
+    Returns:
+        aiohttp.ClientSession: The shared session.
+    """
+    global http_session
+
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+    return http_session
+
+def get_async_slack_client(slack_token: str) -> slack.WebClient:
+    """
+    Returns the long-lived async Slack WebClient for a team's access token, creating it on first use.
+
+    Its methods return coroutines and share the connection pool of `get_http_session`.
+
+    Args:
+        slack_token (str): The Slack API token stored in `team:{id}:slack_access_token`.
+
+    Returns:
+        slack.WebClient: The async WebClient for that token.
+    """
+    client = async_slack_clients.get(slack_token)
+    if client is None or client.session.closed:
+        client = slack.WebClient(token=slack_token, run_async=True, session=get_http_session())
+        async_slack_clients[slack_token] = client
+
+    return client
+
+async def open_dm_channel_async(user_id: str, slack_token: str) -> str:
+    """
+    Opens a direct message channel with a user on Slack without blocking the event loop.
+
+    Shares its cache with `open_dm_channel`.
+
+    Args:
+        user_id (str): The ID of the user to open the channel with.
+        slack_token (str): The Slack API token.
+
+    Returns:
+        str: The ID of the opened channel.
+    """
+    channel_id = dm_channel_cache.get(user_id)
+    if channel_id is not None:
+        return channel_id
+
+    channel_id = await ar.get(f'user:{user_id}:dm_channel')
+
+    if channel_id is None:
+        response = await get_async_slack_client(slack_token).conversations_open(users=user_id)
+        channel_id = response['channel']['id']
+        await ar.set(f'user:{user_id}:dm_channel', channel_id)
+
+    dm_channel_cache[user_id] = channel_id
 
     return channel_id
 
-def get_google_user_email(access_token: str) -> str:
+async def get_google_user_email(access_token: str) -> str:
     """
     Fetches the user's email using the provided access token.
 
@@ -208,9 +473,9 @@ def get_google_user_email(access_token: str) -> str:
     """
     # Use the access token to fetch the user's email
     headers = {'Authorization': f'Bearer {access_token}'}
-    user_info_response = requests.get('https://www.googleapis.com/oauth2/v1/userinfo', headers=headers)
-    user_email = user_info_response.json().get('email')
-    return user_email
+    async with get_http_session().get('https://www.googleapis.com/oauth2/v1/userinfo', headers=headers) as user_info_response:
+        user_info = await user_info_response.json()
+    return user_info.get('email')
 
 def make_date_friendly(date: str, tz: pytz.timezone) -> str:
     """
@@ -249,23 +514,45 @@ def convert_to_utc_seconds(date: str) -> int:
     utc_seconds = int(date_obj.timestamp())
     return utc_seconds
 
-def get_user_timezone(user_id: str, client: slack.WebClient) -> str:
+def get_user_timezone(user_id: str, client: slack.WebClient) -> pytz.timezone:
     """
     Retrieves the timezone of a user based on their user ID.
 
+    The timezone is served from a process-local cache, then from Redis, and only looked up with
+    Slack's `users.info` when both miss. Both caches expire so a changed timezone is picked up again.
+
     Args:
         user_id (str): The ID of the user.
         client (slack.WebClient): The Slack WebClient instance.
 
     Returns:
-        str: The timezone of the user.
+        pytz.timezone: The timezone of the user.
 
     """
-    res = client.users_info(user=user_id)
-    
-    tz_obj = pytz.timezone(res.data['user']['tz'])
+    with timezone_cache_lock:
+        tz_name = timezone_cache.get(user_id)
+
+    if tz_name is None:
+        tz_name = r.get(f'user:{user_id}:timezone')
+
+    if tz_name is None:
+        try:
+            res = client.users_info(user=user_id)
+            tz_name = res.data['user']['tz']
+        except SlackApiError:
+            # fall back to the timezone we saved when the user authorized the app
+            auth_stuff = r.get(f'user:{user_id}')
+            if auth_stuff is None:
+                raise
+            tz_name = json.loads(auth_stuff)['user_timezone']
+            return pytz.timezone(tz_name)
+
+        r.set(f'user:{user_id}:timezone', tz_name, ex=timezone_ttl)
+
+    with timezone_cache_lock:
+        timezone_cache[user_id] = tz_name
 
-    return tz_obj
+    return pytz.timezone(tz_name)
 
 def convert_timezone(date: str, tz: pytz.timezone) -> datetime:
     """
@@ -321,68 +608,272 @@ def create_authorize_me_button(auth_url) -> list:
 
     return message_payload
 
+def get_report_period(text: list, timezone: str) -> tuple:
+    """
+    Works out the days covered by a `[this/next/last] [week/month/quarter]` report.
+
+    Args:
+        text (list): The words of the command. Defaults to `this week` when empty.
+        timezone (str): The timezone of the user, which decides what today is.
+
+    Returns:
+        tuple: The period (`week`, `month` or `quarter`), its first day and the day after its last day.
+
+    Raises:
+        ValueError: If the command isn't a valid period.
+    """
+    when = text[0] if len(text) > 0 else 'this'
+    period = text[1] if len(text) > 1 else 'week'
+
+    if when not in ['this', 'next', 'last'] or period not in ['week', 'month', 'quarter'] or len(text) > 2:
+        raise ValueError(f"Invalid period: {' '.join(text)}")
+
+    today = convert_timezone(datetime.datetime.now(datetime.timezone.utc).isoformat(), timezone).date()
+    shift = {'this': 0, 'next': 1, 'last': -1}[when]
+
+    if period == 'week':
+        # monday to sunday
+        start_date = today - datetime.timedelta(days=today.weekday()) + datetime.timedelta(weeks=shift)
+        end_date = start_date + datetime.timedelta(days=7)
+    elif period == 'month':
+        start_date = today.replace(day=1) + relativedelta(months=shift)
+        end_date = start_date + relativedelta(months=1)
+    else:
+        start_date = today.replace(month=3 * ((today.month - 1) // 3) + 1, day=1) + relativedelta(months=3 * shift)
+        end_date = start_date + relativedelta(months=3)
+
+    return period, start_date, end_date
+
+def format_seconds(seconds: int) -> str:
+    """
+    Formats seconds as hours and minutes.
+
+    Args:
+        seconds (int): The seconds.
+
+    Returns:
+        str: The time as `hours:minutes`.
+    """
+    return f"{seconds // 3600}:{seconds % 3600 // 60}"
+
+def build_capacity_table(period: str, start_date: datetime.date, seconds_by_day: dict) -> str:
+    """
+    Renders the seconds logged per day as a table. A week is one row of days, longer periods get a row per week.
+
+    Args:
+        period (str): The period of the report, see get_report_period.
+        start_date (datetime.date): The first day of the period.
+        seconds_by_day (dict): `YYYY-MM-DD` -> seconds for every day of the period, in order.
+
+    Returns:
+        str: The rendered table.
+    """
+    if period == 'week':
+        return tabulate_dicts([{day: format_seconds(seconds) for day, seconds in seconds_by_day.items()}], table_format='simple_grid')
+
+    weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+    rows = []
+    week_start = start_date - datetime.timedelta(days=start_date.weekday())
+
+    while week_start.strftime('%Y-%m-%d') <= max(seconds_by_day):
+        week_days = [(week_start + datetime.timedelta(days=x)).strftime('%Y-%m-%d') for x in range(7)]
+        row = {'week of': week_days[0]}
+        for weekday, day in zip(weekdays, week_days):
+            row[weekday] = format_seconds(seconds_by_day[day]) if day in seconds_by_day else ''
+        row['total'] = format_seconds(sum(seconds_by_day.get(day, 0) for day in week_days))
+        rows.append(row)
+        week_start += datetime.timedelta(days=7)
+
+    return tabulate_dicts(rows, table_format='simple_grid')
+
 def get_capacity_from_redis(slack_user_id: str, client: slack.WebClient, channel_id: str, auth_stuff: dict, text: list):
+    """
+    Sends the user a table of the time on their calendar by day for a week, month or quarter.
+
+    Args:
+        slack_user_id (str): The Slack user ID.
+        client (slack.WebClient): The Slack WebClient instance.
+        channel_id (str): The ID of the Slack channel.
+        auth_stuff (dict): The user's auth stuff JSON.
+        text (list): The words of the command, e.g. `['last', 'month']`.
+
+    Returns:
+        None
+    """
     auth_stuff = json.loads(auth_stuff)
 
-    start_date= None
-    end_date= None
-
-    if len(text) > 1:
-        if text[0] == 'this':
-            # set start and end dates to this week (monday to sunday)
-            start_date = convert_timezone(datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f%z'), auth_stuff['user_timezone'])
-            # Set start_date to Monday
-            start_date -= datetime.timedelta(days=start_date.weekday())
-            end_date = (start_date + datetime.timedelta(days=7))
-        elif text[0] == 'next':
-            # set start and end dates to next week (monday to sunday)
-            start_date = convert_timezone(datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f%z'), auth_stuff['user_timezone'])
-            # Set start_date to next Monday
-            start_date += datetime.timedelta(days=-start_date.weekday(), weeks=1)
-            end_date = (start_date + datetime.timedelta(days=7))
-        elif text[0] == 'last':
-            # set start and end dates to last week (monday to sunday)
-            start_date = convert_timezone(datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f%z'), auth_stuff['user_timezone'])
-            # Set start_date to last Monday
-            start_date += datetime.timedelta(days=-start_date.weekday(), weeks=-1)
-            end_date = (start_date + datetime.timedelta(days=7))
-        else:
-            # send a message saying that the command is invalid
-            client.chat_postMessage(channel=channel_id, text=f"```Invalid command. Please try again.```")
+    try:
+        period, start_date, end_date = get_report_period(text, auth_stuff['user_timezone'])
+    except ValueError:
+        # send a message saying that the command is invalid
+        client.chat_postMessage(channel=channel_id, text=f"```Invalid command. Please try again with [this/next/last] [week/month/quarter].```")
+        return
 
     #create dates in between start and end date
+    days = [(start_date + datetime.timedelta(days=x)).strftime("%Y-%m-%d") for x in range((end_date - start_date).days)]
 
-    dates = [start_date + datetime.timedelta(days=x) for x in range(0, (end_date-start_date).days)]
+    seconds_by_day = dict(zip(days, load_daily_seconds(slack_user_id, days)))
 
-    capacity = {}
-    for dt in dates:
-        capacity[dt.strftime("%Y-%m-%d")] = 0
+    message = build_capacity_table(period, start_date, seconds_by_day)
 
-    event_ids = r.zrangebyscore(f'user:{slack_user_id}:calEvents', start_date.strftime("%Y%m%d"), end_date.strftime("%Y%m%d"))
+    client.chat_postMessage(channel=channel_id, text=f"```{ message }```")
 
-    events=[]
+def get_team_user_ids(team_id: str) -> list:
+    """
+    Returns the IDs of the users of a team.
 
-    for event in event_ids:
-        events.append(r.hgetall(f"calEvent:{event}"))
+    Users are added to `team:{id}:users` when they run a command. Teams that used the app before that
+    are filled in once with backfill_team_users.
 
-    # loop through events and create a dict with date as key and duration as value
+    Args:
+        team_id (str): The ID of the team.
 
-    for event in events:
-        date = event['start'][:10]
-        if date not in capacity:
-            capacity[date] = int(event['duration'])
-        else:
-            capacity[date] += int(event['duration'])
+    Returns:
+        list: The user IDs, sorted.
+    """
+    return sorted(r.smembers(f'team:{team_id}:users'))
+
+def backfill_team_users(team_id: str, client: slack.WebClient) -> int:
+    """
+    Adds the members of a team's workspace who have authorized the app to `team:{id}:users`.
+
+    Args:
+        team_id (str): The ID of the team.
+        client (slack.WebClient): The team's Slack WebClient.
+
+    Returns:
+        int: The number of users added.
+    """
+    member_ids = []
+    cursor = None
+
+    while True:
+        res = client.users_list(cursor=cursor, limit=200)
+        member_ids.extend(member['id'] for member in res['members'] if not member.get('deleted') and not member.get('is_bot'))
+        cursor = res.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            break
+
+    if not member_ids:
+        return 0
+
+    pipe = r.pipeline(transaction=False)
+    for user_id in member_ids:
+        pipe.exists(f'user:{user_id}')
+    user_ids = [user_id for user_id, exists in zip(member_ids, pipe.execute()) if exists]
+
+    return r.sadd(f'team:{team_id}:users', *user_ids) if user_ids else 0
+
+def can_view_team_report(user_id: str, client: slack.WebClient) -> bool:
+    """
+    Tells whether a user may see the time logged by their whole team.
+
+    Args:
+        user_id (str): The Slack user ID.
+        client (slack.WebClient): The team's Slack WebClient.
+
+    Returns:
+        bool: True for the workspace's admins and owners and the users in `TEAM_REPORT_USERS`.
+    """
+    if user_id in team_report_users:
+        return True
+
+    user = client.users_info(user=user_id).data['user']
+
+    return bool(user.get('is_admin') or user.get('is_owner'))
+
+def build_team_table(period: str, days: list, names: dict, seconds_by_user: dict) -> str:
+    """
+    Renders the time of every user of a team as a table, with a row per user and a team total.
+
+    A week gets a column per day, longer periods a column per week.
+
+    Args:
+        period (str): The period of the report, see get_report_period.
+        days (list): The days of the period as `YYYY-MM-DD` strings, in order.
+        names (dict): User ID -> the name shown for the user.
+        seconds_by_user (dict): User ID -> the seconds for each day, in the order of `days`.
+
+    Returns:
+        str: The rendered table.
+    """
+    if period == 'week':
+        columns = [(day[5:], [index]) for index, day in enumerate(days)]
+    else:
+        weeks = {}
+        for index, day in enumerate(days):
+            date = datetime.date.fromisoformat(day)
+            week_start = date - datetime.timedelta(days=date.weekday())
+            weeks.setdefault(f"wk {week_start.strftime('%m-%d')}", []).append(index)
+        columns = list(weeks.items())
+
+    rows = []
+    team_seconds = [0] * len(days)
+
+    for user_id in sorted(seconds_by_user, key=lambda user_id: names[user_id]):
+        seconds = seconds_by_user[user_id]
+        row = {'user': names[user_id]}
+        for label, indexes in columns:
+            row[label] = format_seconds(sum(seconds[index] for index in indexes))
+        row['total'] = format_seconds(sum(seconds))
+        rows.append(row)
+        team_seconds = [total + value for total, value in zip(team_seconds, seconds)]
+
+    row = {'user': 'team total'}
+    for label, indexes in columns:
+        row[label] = format_seconds(sum(team_seconds[index] for index in indexes))
+    row['total'] = format_seconds(sum(team_seconds))
+    rows.append(row)
+
+    return tabulate_dicts(rows, table_format='simple_grid')
+
+def get_team_logged_time(team_id: str, slack_user_id: str, client: slack.WebClient, channel_id: str, auth_stuff: dict, text: list) -> None:
+    """
+    Sends the user a table of the time on the calendars of everyone on their team for a week, month or quarter.
+    Only users allowed by can_view_team_report get it.
+
+    The users are read in chunks of `TEAM_REPORT_CHUNK_SIZE`, one pipeline per chunk, spread over
+    `TEAM_REPORT_WORKERS` threads.
+
+    Args:
+        team_id (str): The ID of the team.
+        slack_user_id (str): The Slack user ID of the user asking.
+        client (slack.WebClient): The Slack WebClient instance.
+        channel_id (str): The ID of the Slack channel.
+        auth_stuff (dict): The auth stuff JSON of the user asking.
+        text (list): The words of the command, e.g. `['last', 'month']`.
+
+    Returns:
+        None
+    """
+    auth_stuff = json.loads(auth_stuff)
+
+    if not can_view_team_report(slack_user_id, client):
+        client.chat_postMessage(channel=channel_id, text="Only workspace admins and the people set up as team managers can see the team's logged time.")
+        return
+
+    try:
+        period, start_date, end_date = get_report_period(text, auth_stuff['user_timezone'])
+    except ValueError:
+        # send a message saying that the command is invalid
+        client.chat_postMessage(channel=channel_id, text=f"```Invalid command. Please try again with [this/next/last] [week/month/quarter].```")
+        return
+
+    user_ids = get_team_user_ids(team_id)
+
+    days = [(start_date + datetime.timedelta(days=x)).strftime("%Y-%m-%d") for x in range((end_date - start_date).days)]
+
+    chunks = [user_ids[i:i + team_report_chunk_size] for i in range(0, len(user_ids), team_report_chunk_size)]
 
-    for key,item in capacity.items():
-        hours = item // 3600
-        minutes = item % 3600 // 60
-        formatted_time = f"{hours}:{minutes}"
-        capacity[key] = formatted_time
+    with ThreadPoolExecutor(max_workers=max(1, min(team_report_workers, len(chunks)))) as executor:
+        seconds = [user_seconds for chunk_seconds in executor.map(load_users_daily_seconds, chunks, [days] * len(chunks)) for user_seconds in chunk_seconds]
 
-    # order keys in dict
-    capacity = dict(sorted(capacity.items()))
+    # show users by their email, the only name we store for them
+    names = {}
+    for user_id, user in zip(user_ids, r.mget([f'user:{user_id}' for user_id in user_ids]) if user_ids else []):
+        names[user_id] = json.loads(user).get('user_email', user_id) if user else user_id
 
-    message = tabulate_dicts([capacity],table_format='simple_grid')
+    table = build_team_table(period, days, names, dict(zip(user_ids, seconds)))
 
-    client.chat_postMessage(channel=channel_id, text=f"```{ message }```")
\ No newline at end of file
+    header = f"Here's the time logged by your team from {days[0]} to {days[-1]}:"
+    post_listing(client, channel_id, header, [(f'{len(user_ids)} people', table)], filename='team-logged-time.txt')
@@ -1,17 +1,14 @@
-from fastapi import FastAPI, Request, Form, BackgroundTasks, Response, responses
-from gcal import get_events_gcal
-import slack
-from utils import get_google_user_email, open_dm_channel, create_authorize_me_button, get_capacity_from_redis
+from fastapi import BackgroundTasks, FastAPI, Request, Form, Response, responses
+from utils import get_google_user_email, open_dm_channel_async, get_async_slack_client, get_http_session
 import json
-import requests
+import datetime
 import urllib.parse
 import secrets
-import redis_conn
 import os
 from dotenv import load_dotenv
-from jira import create_worklog, get_issue_worklogs, delete_worklog_by_id, get_jira_issues_for_user
-import threading
-from redis_conn import r
+from job_queue import enqueue_async
+from gcal_credentials import token_expiry_key
+from redis_conn import ar
 from fastapi.responses import JSONResponse
 from starlette.middleware.sessions import SessionMiddleware
 import logging
@@ -35,6 +32,11 @@ user_scope = os.environ.get('SLACK_USER_SCOPES')
 app = FastAPI()
 app.add_middleware(SessionMiddleware, secret_key=fastapi_key)
 
+@app.on_event('shutdown')
+async def shut_down():
+    await get_http_session().close()
+    await ar.aclose()
+
 @app.get('/slack-authorize')
 async def slack_authorize(request: Request):
     # redirect the user to the Slack authorization page with the client ID and scopes
@@ -75,21 +77,22 @@ async def slack_oauth(request: Request):
         return responses.RedirectResponse(url='/slack-authorize')
 
     # Exchange the authorization code for an access token
-    response = requests.post('https://slack.com/api/oauth.v2.access',data={
+    async with get_http_session().post('https://slack.com/api/oauth.v2.access',data={
         'code': code,
         'client_id': slack_client_id,
         'client_secret': slack_client_secret
-    })
-
-    print(response.json())
+    }) as response:
+        oauth_response = await response.json()
 
     # Process response
-    slack_access_token = response.json().get('access_token')
-    user_id = response.json().get('authed_user').get('id')
-    team_id = response.json().get('team').get('id')
+    slack_access_token = oauth_response.get('access_token')
+    user_id = oauth_response.get('authed_user').get('id')
+    team_id = oauth_response.get('team').get('id')
+
+    logging.info(f'Slack app installed for team {team_id} by user {user_id}')
 
     # Save the access token in the database
-    redis_conn.r.set(f'team:{team_id}:slack_access_token', slack_access_token)
+    await ar.set(f'team:{team_id}:slack_access_token', slack_access_token)
 
     html_content = """
         <!DOCTYPE html>
@@ -109,64 +112,81 @@ async def slack_oauth(request: Request):
 async def index():
     return Response(status_code=200)
 
+def ephemeral(text: str) -> JSONResponse:
+    """
+    Builds the reply to a slash command, which only the user who ran it can see.
+
+    Slack gives up on a slash command after 3 seconds, so handlers only validate the command,
+    enqueue the work and answer with this right away.
+
+    Args:
+        text (str): The text of the reply.
+
+    Returns:
+        JSONResponse: The reply.
+    """
+    return JSONResponse(content={"response_type": "ephemeral", "text": text})
+
+async def update_original_message(response_url: str, text: str) -> None:
+    """
+    Replaces the message an interaction came from.
+
+    Args:
+        response_url (str): The response URL of the interaction.
+        text (str): The new text of the message.
+
+    Returns:
+        None
+    """
+    # Prepare the message update payload
+    updated_message = {
+        "replace_original": "true",
+        "text": text
+    }
+
+    # POST request to update the original message
+    async with get_http_session().post(response_url, json=updated_message) as response:
+        if response.status != 200:
+            logging.error(f"Error updating message: {await response.text()}")
+
 @app.post('/list-events')
-async def list_events(background_tasks: BackgroundTasks, user_id: str = Form(...), team_id: str = Form(...), text: str = Form(default='')):
+async def list_events(user_id: str = Form(...), team_id: str = Form(...), text: str = Form(default=''), trigger_id: str = Form(default=None)):
     """
     Endpoint for listing events based on the provided date range or time period.
 
     Args:
-        background_tasks (BackgroundTasks): Background tasks to be executed.
         user_id (str): User ID.
         team_id (str): Team ID.
         text (str, optional): Text input for specifying the date range or time period. Defaults to ''.
+        trigger_id (str, optional): Slack's ID of the command, used to drop resent commands. Defaults to None.
 
     Returns:
-        Response: HTTP response indicating the success of the request.
+        JSONResponse: The ephemeral reply to the command.
     """
-    auth_stuff = r.get(f'user:{user_id}')
-    slack_token = r.get(f'team:{team_id}:slack_access_token')
-    channel_id = open_dm_channel(user_id, slack_token)
-    client = slack.WebClient(token=slack_token)
-
     text = text.split()
 
     if len(text) == 0:
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"Please provide a date range. Valid options are: `today`, `yesterday`, `next <number of days>`, `last <number of days>`")
-        return Response(status_code=200)
+        return ephemeral(f"Please provide a date range. Valid options are: `today`, `yesterday`, `next <number of days>`, `last <number of days>`")
 
     if len(text) == 1 and text[0] not in ['today', 'yesterday']:
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"Please provide a time period. Valid options are: `today`, `yesterday`, `next <number of days>`, `last <number of days>`")
-        return Response(status_code=200)
+        return ephemeral(f"Please provide a time period. Valid options are: `today`, `yesterday`, `next <number of days>`, `last <number of days>`")
     elif len(text) == 2 and text[0] not in ['next', 'last']:
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"Please provide a time period. Valid options are: `today`, `yesterday`, `next <number of days>`, `last <number of days>`")
-        return Response(status_code=200)
-    elif len(text) == 1 and text[0] in ['today', 'yesterday']:
-        # send user a message
-        client.chat_postMessage(channel=channel_id, text=f"Getting events for { text[0] }...")
-    elif len(text) == 2 and text[0] in ['next', 'last']:
-        # send user a message
-        client.chat_postMessage(channel=channel_id, text=f"Getting events for { text[0] } { text[1] }...")
-
-    if auth_stuff is None:
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"You haven't authorized me yet. Try running `/setup`")
-        return Response(status_code=200)
-    else:
-        background_tasks.add_task(get_events_gcal, user_id, google_token_url, google_client_id, google_client_secret, text, auth_stuff, client, channel_id)
+        return ephemeral(f"Please provide a time period. Valid options are: `today`, `yesterday`, `next <number of days>`, `last <number of days>`")
+    elif len(text) > 2:
+        return ephemeral(f"Please provide a time period. Valid options are: `today`, `yesterday`, `next <number of days>`, `last <number of days>`")
 
-    return Response(status_code=200)
+    await enqueue_async('list_events', team_id, user_id, text, dedupe_key=trigger_id)
+
+    return ephemeral(f"Getting events for { ' '.join(text) }...")
 
 @app.post('/log-jira-worklog')
-async def log_time_in_jira(background_tasks: BackgroundTasks, request: Request):
+async def log_time_in_jira(request: Request, background_tasks: BackgroundTasks):
     """
     Logs time in JIRA based on the user's action in Slack.
 
     Args:
-        background_tasks (BackgroundTasks): Background tasks to be executed.
         request (Request): The incoming request object.
+        background_tasks (BackgroundTasks): Runs the update of the original message after the response is sent.
 
     Returns:
         Response: The response object indicating the status of the request.
@@ -175,17 +195,15 @@ async def log_time_in_jira(background_tasks: BackgroundTasks, request: Request):
     payload = json.loads(form_data.get("payload"))
     response_url = payload['response_url']
     action_id = payload['actions'][0]['action_id'].split('|')[0]
-    slack_token = r.get(f'team:{payload["team"]["id"]}:slack_access_token')
-    client = slack.WebClient(token=slack_token)
     slack_user_id = payload['user']['id']
-    channel_id = open_dm_channel(slack_user_id, slack_token)
-    
+
     if action_id == 'update_jira_yes':
         # FES ticket keys
         values = payload['actions'][0]['value'].split('|')
 
-        background_tasks.add_task(create_worklog,values, slack_user_id, client, channel_id)
-        
+        # a second click on the same message, or Slack resending it, joins the job of the first one
+        message_ts = payload.get('container', {}).get('message_ts')
+        await enqueue_async('log_worklogs', payload['team']['id'], slack_user_id, values, dedupe_key=f'log_worklogs:{slack_user_id}:{message_ts}')
 
         response_text = "Working on it..."
     elif action_id == 'update_jira_no':
@@ -196,18 +214,7 @@ async def log_time_in_jira(background_tasks: BackgroundTasks, request: Request):
     else:
         response_text = "Unknown action."
 
-    # Prepare the message update payload
-    updated_message = {
-        "replace_original": "true",
-        "text": response_text
-    }
-    
-    # POST request to update the original message
-    response = requests.post(response_url, json=updated_message)
-
-    if response.status_code != 200:
-        print("Error updating message:", response.text)
-
+    background_tasks.add_task(update_original_message, response_url, response_text)
 
     # Sending a simple text response back to Slack
     return Response(status_code=200)
@@ -219,7 +226,7 @@ async def testes(request: Request):
     return JSONResponse(content={"challenge": challenge})
 
 @app.post('/setup')
-async def setup(user_id: str = Form(...), text: str = Form(default=''), team_id: str = Form(...)):
+async def setup(user_id: str = Form(...), text: str = Form(default=''), team_id: str = Form(...), trigger_id: str = Form(default=None)):
     """
     Endpoint for setting up the JIRA integration.
 
@@ -227,51 +234,17 @@ async def setup(user_id: str = Form(...), text: str = Form(default=''), team_id:
         user_id (str): The ID of the user.
         text (str): The JIRA API token provided by the user. Defaults to an empty string.
         team_id (str): The ID of the team.
+        trigger_id (str, optional): Slack's ID of the command, used to drop resent commands. Defaults to None.
 
     Returns:
-        Response: The response object indicating the success of the setup process.
+        JSONResponse: The ephemeral reply to the command.
     """
-    slack_token = r.get(f'team:{team_id}:slack_access_token')
-    channel_id = open_dm_channel(user_id, slack_token)
-
     if len(text) == 0:
-        # Send a message to the user
-        client = slack.WebClient(token=slack_token)
-        client.chat_postMessage(channel=channel_id, text=f"Please provide your JIRA API token. You can find it here: https://id.atlassian.com/manage-profile/security/api-tokens")
-        return Response(status_code=200)
+        return ephemeral(f"Please provide your JIRA API token. You can find it here: https://id.atlassian.com/manage-profile/security/api-tokens")
 
-    # Generate a secure, random state value
-    random_state = secrets.token_urlsafe()
-    state = {"state":random_state,"channel":channel_id,"user":user_id, "jira_api_token": text, "slack_token": slack_token}
-    encoded_state = urllib.parse.quote(json.dumps(state))
+    await enqueue_async('setup', team_id, user_id, text.strip(), dedupe_key=trigger_id)
 
-    # Set scopes to include in the authorization request
-    scopes = ['https://www.googleapis.com/auth/calendar.readonly', 'https://www.googleapis.com/auth/userinfo.email']
-
-    # Make a list of scopes into a string
-    scopes_string = ' '.join(scopes)
-
-    # Construct the full URL
-    params = {
-        'client_id': google_client_id,
-        'redirect_uri': google_redirect_uri,
-        'response_type': 'code',
-        'scope': scopes_string,
-        'state': encoded_state,
-        'access_type': 'offline', # If you need a refresh token
-        'include_granted_scopes': 'true', # To request incremental authorization
-        'prompt': 'consent' # To always prompt the user for authorization
-    }
-
-    auth_url = google_auth_base_url + '?' + urllib.parse.urlencode(params)
-
-    message = create_authorize_me_button(auth_url)
-
-    # Send the user a link to the Google Auth page
-    client = slack.WebClient(token=slack_token)
-    client.chat_postMessage(channel=channel_id, blocks=message)
-
-    return Response(status_code=200)
+    return ephemeral(f"Sending you a link to connect your Google Calendar...")
 
 @app.get('/oauth2callback')
 async def oauth2callback(request: Request):
@@ -303,37 +276,45 @@ async def oauth2callback(request: Request):
     slack_token = state_data.get('slack_token', None)
 
     # Exchange the authorization code for an access token
-    response = requests.post(google_token_url, json={
+    async with get_http_session().post(google_token_url, json={
         'code': code,
         'client_id': google_client_id,
         'client_secret': google_client_secret,
         'redirect_uri': google_redirect_uri,
         'grant_type': 'authorization_code'
-    })
+    }) as response:
+        token_response = await response.json()
 
     # get user email
-    user_email = get_google_user_email(response.json().get('access_token'))
+    user_email = await get_google_user_email(token_response.get('access_token'))
 
     # get user timezone from slack
-    client = slack.WebClient(token=slack_token)
-    slack_res = client.users_info(user=user_id)
+    client = get_async_slack_client(slack_token)
+    slack_res = await client.users_info(user=user_id)
     user_timezone = slack_res['user']['tz']
 
+    # remember when the access token expires so it can be refreshed before that
+    expiry = datetime.datetime.utcnow() + datetime.timedelta(seconds=token_response.get('expires_in', 3600))
+
     # Process response
     access_token = {
-        'access_token': response.json().get('access_token'),
-        'refresh_token': response.json().get('refresh_token'),
+        'access_token': token_response.get('access_token'),
+        'refresh_token': token_response.get('refresh_token'),
+        'expiry': expiry.isoformat(),
         'token_uri': google_token_url,
         'user_email': user_email,
         'jira_api_token': state_data.get('jira_api_token'),
         'user_timezone': user_timezone,
     }
 
-    # Save the access token and email in the database
-    redis_conn.r.set(f'user:{user_id}', json.dumps(access_token))
+    # Save the access token and email in the database, and have the workers refresh the token before it expires
+    pipe = ar.pipeline()
+    pipe.set(f'user:{user_id}', json.dumps(access_token))
+    pipe.zadd(token_expiry_key, {user_id: expiry.replace(tzinfo=datetime.timezone.utc).timestamp()})
+    await pipe.execute()
 
     # open channel
-    channel_id = open_dm_channel(user_id, slack_token)
+    channel_id = await open_dm_channel_async(user_id, slack_token)
 
     html_content = """
         <!DOCTYPE html>
@@ -348,13 +329,12 @@ async def oauth2callback(request: Request):
         """
 
     # Send a message to the user
-    client = slack.WebClient(token=slack_token)
-    client.chat_postMessage(channel=channel_id, text=f"You have been authorized! Try running `/list-events today` or `/list-events yesterday` to get your Google Calendar events. You can also try `/list-events next 3` or `/list-events last 7`")
+    await client.chat_postMessage(channel=channel_id, text=f"You have been authorized! Try running `/list-events today` or `/list-events yesterday` to get your Google Calendar events. You can also try `/list-events next 3` or `/list-events last 7`")
 
     return responses.HTMLResponse(content=html_content, status_code=200)
 
 @app.post('/get-worklogs')
-async def get_worklogs(user_id: str = Form(...), team_id: str = Form(...),text: str = Form(default='') ):
+async def get_worklogs(user_id: str = Form(...), team_id: str = Form(...),text: str = Form(default=''), trigger_id: str = Form(default=None)):
     """
     Retrieves worklogs for a JIRA issue and sends them to the user on Slack.
 
@@ -362,34 +342,20 @@ async def get_worklogs(user_id: str = Form(...), team_id: str = Form(...),text:
     - user_id (str): The ID of the user making the request.
     - team_id (str): The ID of the team associated with the user.
     - text (str): The JIRA issue key.
+    - trigger_id (str): Slack's ID of the command, used to drop resent commands.
 
     Returns:
-    - Response: A response object indicating the status of the request.
+    - JSONResponse: The ephemeral reply to the command.
     """
-    slack_token = r.get(f'team:{team_id}:slack_access_token')
-    auth_stuff = r.get(f'user:{user_id}')
-    channel_id = open_dm_channel(user_id, slack_token)
-    client = slack.WebClient(token=slack_token)
-
     if len(text) == 0:
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"Please provide a JIRA issue key.")
-        return Response(status_code=200)
+        return ephemeral(f"Please provide a JIRA issue key.")
 
-    # send user a message
-    client.chat_postMessage(channel=channel_id, text=f"Getting worklogs for { text.upper() }...")
+    await enqueue_async('get_worklogs', team_id, user_id, text, dedupe_key=trigger_id)
 
-    if auth_stuff is None:
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"You haven't authorized me yet. Try running `/setup`")
-        return '', 200
-    else:
-        get_issue_worklogs(text, auth_stuff, channel_id, client, user_id)
-
-    return Response(status_code=200)
+    return ephemeral(f"Getting worklogs for { text.upper() }...")
 
 @app.post('/delete-worklog')
-async def delete_worklog(user_id: str = Form(...), team_id: str = Form(...), text: str = Form(default='')):
+async def delete_worklog(user_id: str = Form(...), team_id: str = Form(...), text: str = Form(default=''), trigger_id: str = Form(default=None)):
     """
     Deletes a worklog entry.
 
@@ -397,81 +363,61 @@ async def delete_worklog(user_id: str = Form(...), team_id: str = Form(...), tex
     - user_id (str): The ID of the user making the request.
     - team_id (str): The ID of the team associated with the user.
     - text (str): The text payload containing the FES ticket number and worklog ID.
+    - trigger_id (str): Slack's ID of the command, used to drop resent commands.
 
     Returns:
-    - Response: The HTTP response indicating the status of the request.
+    - JSONResponse: The ephemeral reply to the command.
     """
-    slack_token = r.get(f'team:{team_id}:slack_access_token')
-    auth_stuff = r.get(f'user:{user_id}')
-    channel_id = open_dm_channel(user_id, slack_token)
-    client = slack.WebClient(token=slack_token)
+    # get text payload
+    text = text.split()
 
     if len(text) < 2:
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"Please provide an FES ticket number and a worklog ID.")
-        return Response(status_code=200)
-
-    if auth_stuff is None:
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"You haven't authorized me yet. Try running `/setup`")
-        return Response(status_code=200)
-    else:
-        # get text payload
-        text =text.split(' ')
-        wls = threading.Thread(target=delete_worklog_by_id, args=(text, user_id, client, channel_id, auth_stuff))
-        wls.start()
+        return ephemeral(f"Please provide an FES ticket number and a worklog ID.")
 
-    return Response(status_code=200)
+    await enqueue_async('delete_worklog', team_id, user_id, text, dedupe_key=trigger_id)
+
+    return ephemeral(f"Deleting worklog { text[1] } from { text[0].upper() }...")
 
 @app.post('/get-my-open-issues')
-async def get_jira_issues_by_user(background_tasks: BackgroundTasks, user_id: str = Form(...), team_id: str = Form(...)):
+async def get_jira_issues_by_user(user_id: str = Form(...), team_id: str = Form(...), trigger_id: str = Form(default=None)):
     """
     Retrieves Jira issues for a specific user and sends them to the user's Slack channel.
 
     Parameters:
-    - background_tasks (BackgroundTasks): Background tasks to be executed asynchronously.
     - user_id (str): The ID of the user.
     - team_id (str): The ID of the team.
+    - trigger_id (str): Slack's ID of the command, used to drop resent commands.
 
     Returns:
-    - Response: HTTP response indicating the status of the request.
+    - JSONResponse: The ephemeral reply to the command.
     """
-    slack_token = r.get(f'team:{team_id}:slack_access_token')
-    auth_stuff = r.get(f'user:{user_id}')
-    channel_id = open_dm_channel(user_id, slack_token)
-    client = slack.WebClient(token=slack_token)
-
-    if auth_stuff is None:
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"You haven't authorized me yet. Try running `/setup`")
-        return Response(status_code=200)
-    else:
-        # get text payload
-        background_tasks.add_task(get_jira_issues_for_user, auth_stuff, client, channel_id)
-        # send message to user
-        client.chat_postMessage(channel=channel_id, text=f"Getting your open issues...")
+    await enqueue_async('get_open_issues', team_id, user_id, dedupe_key=trigger_id)
 
-    return Response(status_code=200)
+    return ephemeral(f"Getting your open issues...")
 
 @app.post('/show-my-logged-time')
-async def show_capacity(background_tasks: BackgroundTasks, user_id: str = Form(...), team_id: str = Form(...), text: str = Form(default='')):
-    slack_token = r.get(f'team:{team_id}:slack_access_token')
-    auth_stuff = r.get(f'user:{user_id}')
-    channel_id = open_dm_channel(user_id, slack_token)
-    client = slack.WebClient(token=slack_token)
-    text = text.split()
+async def show_capacity(user_id: str = Form(...), team_id: str = Form(...), text: str = Form(default=''), trigger_id: str = Form(default=None)):
+    await enqueue_async('show_logged_time', team_id, user_id, text.split(), dedupe_key=trigger_id)
 
-    if auth_stuff is None:
-        # Send a message to the user
-        client.chat_postMessage(channel=channel_id, text=f"You haven't authorized me yet. Try running `/setup`")
-        return Response(status_code=200)
-    else:
-        # get text payload
-        background_tasks.add_task(get_capacity_from_redis, user_id, client, channel_id, auth_stuff, text)
-        # send message to user
-        client.chat_postMessage(channel=channel_id, text=f"Getting your logged time...")
-    
-    return Response(status_code=200)
+    return ephemeral(f"Getting your logged time...")
+
+@app.post('/team-logged-time')
+async def team_logged_time(user_id: str = Form(...), team_id: str = Form(...), text: str = Form(default=''), trigger_id: str = Form(default=None)):
+    """
+    Sends the user the time logged by everyone on their team.
+
+    Parameters:
+    - user_id (str): The ID of the user.
+    - team_id (str): The ID of the team.
+    - text (str): The period, e.g. `last month`.
+    - trigger_id (str): Slack's ID of the command, used to drop resent commands.
+
+    Returns:
+    - JSONResponse: The ephemeral reply to the command.
+    """
+    await enqueue_async('team_logged_time', team_id, user_id, text.split(), dedupe_key=trigger_id)
+
+    return ephemeral(f"Getting your team's logged time...")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+from dotenv import load_dotenv
+import job_queue
+import gcal_credentials
+import maintenance
+import tasks  # registers the job handlers
+from gcal import get_calendar_service
+import worklog_indexer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',filename='worker.log')
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# seconds between checks for jobs whose worker died or whose retry is due
+requeue_interval = int(os.environ.get('JOB_REQUEUE_INTERVAL', 15))
+
+stop = threading.Event()
+
+
+def heartbeat(job_id: str, done: threading.Event) -> None:
+    """
+    Keeps extending a running job's visibility timeout until it's done.
+
+    Args:
+        job_id (str): The ID of the job.
+        done (threading.Event): Set when the job finished.
+
+    Returns:
+        None
+    """
+    while not done.wait(job_queue.visibility_timeout / 3):
+        job_queue.touch(job_id)
+
+def work() -> None:
+    """
+    Takes jobs off the queue and runs them until the worker is stopped.
+
+    Returns:
+        None
+    """
+    last_requeue = 0
+
+    while not stop.is_set():
+        if time.time() - last_requeue > requeue_interval:
+            last_requeue = time.time()
+            moved = job_queue.requeue_expired()
+            if moved:
+                logger.info(f'Requeued {moved} jobs.')
+
+            if worklog_indexer.is_configured():
+                # one indexer job per interval, however many workers try to schedule it
+                slot = int(time.time() // worklog_indexer.index_interval)
+                job_queue.enqueue('index_worklogs', dedupe_key=f'index_worklogs:{slot}')
+
+            # one token refresh job per interval, the same way
+            slot = int(time.time() // gcal_credentials.refresh_interval)
+            job_queue.enqueue('refresh_google_tokens', dedupe_key=f'refresh_google_tokens:{slot}', dedupe_seconds=gcal_credentials.refresh_interval)
+
+            # one garbage collection job per interval, the same way. The interval can be longer than dedupe keys are kept by default
+            slot = int(time.time() // maintenance.gc_interval)
+            job_queue.enqueue('collect_garbage', dedupe_key=f'collect_garbage:{slot}', dedupe_seconds=maintenance.gc_interval)
+
+        job_id, job = job_queue.reserve()
+        if job_id is None:
+            continue
+
+        if int(job['attempts']) > job_queue.max_attempts:
+            # the job keeps taking its worker down with it
+            job_queue.fail(job_id, job, 'Visibility timeout passed too many times.')
+            continue
+
+        done = threading.Event()
+        threading.Thread(target=heartbeat, args=(job_id, done), daemon=True).start()
+
+        try:
+            logger.info(f"Running job {job_id} ({job['name']}).")
+            job_queue.run_job(job)
+            job_queue.ack(job_id)
+        except Exception:
+            logger.exception(f"Job {job_id} ({job['name']}) failed.")
+            job_queue.fail(job_id, job, traceback.format_exc())
+        finally:
+            done.set()
+
+def run_process(threads: int) -> None:
+    """
+    Runs a worker process with a number of worker threads.
+
+    Args:
+        threads (int): The number of jobs the process runs at the same time.
+
+    Returns:
+        None
+    """
+    # finish the running jobs on shutdown instead of dropping them
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    # build the Calendar API service once, before the first /list-events job
+    get_calendar_service()
+
+    workers = [threading.Thread(target=work, name=f'worker-{i}') for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs the background jobs of the Jira Worklogs Tool.')
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('WORKER_PROCESSES', 1)))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WORKER_THREADS', 4)))
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        run_process(args.threads)
+    else:
+        processes = [multiprocessing.Process(target=run_process, args=(args.threads,)) for _ in range(args.processes)]
+
+        # pass a shutdown on to the worker processes
+        signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes])
+
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
@@ -0,0 +1,101 @@
+import logging
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from jira_client import JiraClient
+from job_queue import keep_lock
+from redis.exceptions import LockError
+from redis_conn import r
+from worklog_store import get_changed_worklog_ids, list_worklogs, index_worklogs, unindex_worklogs, index_cursor_key, index_checked_key, list_batch_size
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# the jira account the indexer reads with. It only indexes the worklogs this account can see
+indexer_email = os.environ.get('JIRA_INDEXER_EMAIL')
+indexer_api_token = os.environ.get('JIRA_INDEXER_API_TOKEN')
+
+# seconds between indexer runs
+index_interval = int(os.environ.get('JIRA_INDEX_INTERVAL', 300))
+
+# days of worklogs indexed on the first run
+backfill_days = int(os.environ.get('JIRA_INDEX_BACKFILL_DAYS', 90))
+
+jira = None
+
+
+def is_configured() -> bool:
+    """
+    Tells whether indexer credentials are set.
+
+    Returns:
+        bool: True if the indexer can run.
+    """
+    return bool(indexer_email and indexer_api_token)
+
+def run_indexer() -> int:
+    """
+    Pulls the worklogs jira updated or deleted since the last run into the site-wide index.
+
+    The cursor is only moved forward once everything up to it is indexed, so a failed run is
+    picked up again from the same point. Only one run happens at a time across all workers, the
+    lock is extended for as long as the run lasts.
+
+    Returns:
+        int: The number of worklogs indexed or removed, or 0 if another run holds the lock.
+    """
+    global jira
+
+    if jira is None:
+        jira = JiraClient(indexer_email, indexer_api_token)
+
+    lock = r.lock('lock:jira:worklog_index', timeout=index_interval * 2, thread_local=False)
+    if not lock.acquire(blocking=False):
+        logger.info('Worklog indexer is already running.')
+        return 0
+
+    done = threading.Event()
+    threading.Thread(target=keep_lock, args=(lock, done), daemon=True).start()
+
+    try:
+        since = r.get(index_cursor_key)
+        since = int(since) if since else int((time.time() - backfill_days * 86400) * 1000)
+
+        updated_ids, updated_until = get_changed_worklog_ids(jira, 'updated', since)
+        deleted_ids, deleted_until = get_changed_worklog_ids(jira, 'deleted', since)
+
+        for i in range(0, len(updated_ids), list_batch_size):
+            index_worklogs(list_worklogs(jira, updated_ids[i:i + list_batch_size]))
+
+        until = min(updated_until, deleted_until)
+        unindex_worklogs(deleted_ids, until)
+
+        pipe = r.pipeline()
+        pipe.set(index_cursor_key, until)
+        pipe.set(index_checked_key, int(time.time()))
+        pipe.execute()
+
+        logger.info(f'Indexed {len(updated_ids)} updated and {len(deleted_ids)} deleted worklogs since {since}.')
+        return len(updated_ids) + len(deleted_ids)
+    finally:
+        done.set()
+        try:
+            lock.release()
+        except LockError:
+            # the run took longer than the lock's timeout, it's already gone
+            pass
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', filename='indexer.log')
+
+    if not is_configured():
+        raise SystemExit('Set JIRA_INDEXER_EMAIL and JIRA_INDEXER_API_TOKEN to run the worklog indexer.')
+
+    while True:
+        try:
+            run_indexer()
+        except Exception:
+            logger.exception('Worklog indexer run failed.')
+        time.sleep(index_interval)
@@ -0,0 +1,434 @@
+import datetime
+import json
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from jira_client import JiraClient
+from redis_conn import r
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# worklogs fetched per request when an issue is loaded for the first time
+page_size = int(os.environ.get('JIRA_WORKLOG_PAGE_SIZE', 1000))
+
+# seconds a stored issue is served without asking jira for changes
+refresh_interval = int(os.environ.get('JIRA_WORKLOG_REFRESH_INTERVAL', 30))
+
+# seconds after which an issue is fetched again in full instead of catching up on the changes since
+max_incremental_age = int(os.environ.get('JIRA_WORKLOG_MAX_INCREMENTAL_AGE', 86400))
+
+# jira's limit of worklog IDs per /worklog/list request
+list_batch_size = 1000
+
+# seconds the site-wide worklog index may lag behind before issue lookups stop using it, see worklog_indexer
+index_max_lag = int(os.environ.get('JIRA_INDEX_MAX_LAG', 900))
+
+# the site-wide worklog index: id -> compact worklog, and the sorted sets of each issue's worklogs
+index_key = 'jira:worklogs'
+index_cursor_key = 'jira:worklog_index:since'
+index_checked_key = 'jira:worklog_index:checked_at'
+
+
+class WorklogFetchError(Exception):
+    """Raised when jira refuses to return the worklogs of an issue."""
+
+
+def error_message(response) -> str:
+    """
+    Returns the first error message of a failed jira response.
+
+    Args:
+        response (requests.Response): The response from jira.
+
+    Returns:
+        str: The error message, or the body if there is none.
+    """
+    try:
+        return (response.json().get('errorMessages') or [response.text])[0]
+    except ValueError:
+        return response.text
+
+def to_epoch_ms(timestamp: str) -> int:
+    """
+    Converts a jira timestamp like `2024-01-01T10:00:00.000-0600` to epoch milliseconds.
+
+    Args:
+        timestamp (str): The jira timestamp.
+
+    Returns:
+        int: The epoch milliseconds.
+    """
+    return int(datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f%z').timestamp() * 1000)
+
+def compact_worklog(worklog: dict) -> dict:
+    """
+    Keeps the fields of a jira worklog that are shown or indexed.
+
+    Args:
+        worklog (dict): The worklog as returned by jira.
+
+    Returns:
+        dict: The compact worklog.
+    """
+    return {
+        'id': worklog['id'],
+        'issue_id': worklog['issueId'],
+        'author': worklog['author']['displayName'],
+        'account_id': worklog['author'].get('accountId'),
+        'started': worklog['started'],
+        'time_spent': worklog['timeSpent'],
+        'seconds': worklog['timeSpentSeconds'],
+        'updated': to_epoch_ms(worklog['updated']),
+        'visibility': worklog.get('visibility'),
+    }
+
+def copy_key(issue_key: str, account_id: str) -> str:
+    """
+    Returns the key of the copy of an issue's worklogs as one Jira account sees them.
+
+    Worklogs can be restricted to a group or role, so every account gets its own copy.
+
+    Args:
+        issue_key (str): The key of the issue.
+        account_id (str): The Jira accountId the worklogs were fetched as.
+
+    Returns:
+        str: The redis key of the hash of worklogs, `_meta` is appended for its sync state.
+    """
+    return f'issue:{issue_key}:{account_id}:worklogs'
+
+def get_changed_worklog_ids(jira: JiraClient, change: str, since: int, limit: int = None) -> tuple:
+    """
+    Pages through the IDs of the worklogs jira updated or deleted since a point in time.
+
+    Args:
+        jira (JiraClient): The Jira client to ask with.
+        change (str): `updated` or `deleted`.
+        since (int): The point in time as epoch milliseconds.
+        limit (int, optional): Stop paging once there are more IDs than this. Defaults to None.
+
+    Returns:
+        tuple: The worklog IDs and the epoch milliseconds to ask from next time, or (None, None)
+        if there are more than `limit` IDs.
+
+    Raises:
+        WorklogFetchError: If jira doesn't return the changes.
+    """
+    worklog_ids = []
+
+    while True:
+        response = jira.get(f'/rest/api/3/worklog/{change}', params={'since': since})
+        if response.status_code != 200:
+            raise WorklogFetchError(error_message(response))
+        res = response.json()
+
+        worklog_ids.extend(str(value['worklogId']) for value in res['values'])
+        since = res['until']
+
+        if limit is not None and len(worklog_ids) > limit:
+            return None, None
+
+        if res['lastPage']:
+            return worklog_ids, since
+
+def list_worklogs(jira: JiraClient, worklog_ids: list) -> list:
+    """
+    Fetches worklogs by ID, `list_batch_size` at a time.
+
+    Args:
+        jira (JiraClient): The Jira client to ask with.
+        worklog_ids (list): The IDs of the worklogs.
+
+    Returns:
+        list: The compact worklogs. Worklogs the client can't see are left out.
+
+    Raises:
+        WorklogFetchError: If jira doesn't return the worklogs.
+    """
+    worklogs = []
+
+    for i in range(0, len(worklog_ids), list_batch_size):
+        response = jira.post('/rest/api/3/worklog/list', data=json.dumps({'ids': [int(worklog_id) for worklog_id in worklog_ids[i:i + list_batch_size]]}))
+        if response.status_code != 200:
+            raise WorklogFetchError(error_message(response))
+        worklogs.extend(compact_worklog(worklog) for worklog in response.json())
+
+    return worklogs
+
+def fetch_issue_worklogs(issue_key: str, jira: JiraClient) -> list:
+    """
+    Fetches all worklogs of an issue, following `startAt` until every page is in.
+
+    Args:
+        issue_key (str): The key of the issue.
+        jira (JiraClient): The Jira client to ask with.
+
+    Returns:
+        list: The compact worklogs.
+
+    Raises:
+        WorklogFetchError: If jira doesn't return the worklogs, e.g. because the issue doesn't exist.
+    """
+    worklogs = []
+    start_at = 0
+
+    while True:
+        response = jira.get(f'/rest/api/3/issue/{issue_key}/worklog', params={'startAt': start_at, 'maxResults': page_size})
+
+        if response.status_code != 200:
+            raise WorklogFetchError(error_message(response))
+
+        res = response.json()
+        worklogs.extend(compact_worklog(worklog) for worklog in res['worklogs'])
+        start_at += len(res['worklogs'])
+
+        if len(res['worklogs']) == 0 or start_at >= res['total']:
+            return worklogs
+
+def store_issue_worklogs(key: str, worklogs: list, synced_at: int, replace: bool = False, deleted_ids: list = None) -> None:
+    """
+    Writes worklogs of an issue and when they were synced in one transaction.
+
+    Args:
+        key (str): The key of the copy, see `copy_key`.
+        worklogs (list): The compact worklogs to add or overwrite.
+        synced_at (int): Epoch milliseconds the worklogs are up to date with.
+        replace (bool, optional): Drop the worklogs that were stored before. Defaults to False.
+        deleted_ids (list, optional): IDs of worklogs to remove. Defaults to None.
+
+    Returns:
+        None
+    """
+    pipe = r.pipeline()
+
+    if replace:
+        pipe.delete(key)
+    if deleted_ids:
+        pipe.hdel(key, *deleted_ids)
+    if worklogs:
+        pipe.hset(key, mapping={worklog['id']: json.dumps(worklog) for worklog in worklogs})
+        pipe.hset('jira:issue_keys', worklogs[0]['issue_id'], key.split(':')[1])
+
+    meta = {'synced_at': synced_at, 'checked_at': int(time.time())}
+    if worklogs:
+        meta['issue_id'] = worklogs[0]['issue_id']
+    pipe.hset(f'{key}_meta', mapping=meta)
+
+    pipe.execute()
+
+def refresh_issue_worklogs(issue_key: str, issue_id: str, jira: JiraClient, since: int) -> None:
+    """
+    Catches a stored issue up with the worklogs jira updated or deleted since it was last synced.
+
+    The changes come from a feed that covers the whole site. Once it lists more worklogs than the
+    issue has, the issue is fetched again in full instead, which takes fewer requests.
+
+    Args:
+        issue_key (str): The key of the issue.
+        issue_id (str): The ID of the issue, which is what changed worklogs are matched on.
+        jira (JiraClient): The Jira client to ask with.
+        since (int): Epoch milliseconds the stored worklogs are up to date with.
+
+    Returns:
+        None
+    """
+    key = copy_key(issue_key, jira.get_account_id())
+    now = int(time.time() * 1000)
+    limit = r.hlen(key)
+
+    updated_ids, until = get_changed_worklog_ids(jira, 'updated', since, limit)
+    deleted_ids, _ = get_changed_worklog_ids(jira, 'deleted', since, limit) if updated_ids is not None else (None, None)
+
+    if updated_ids is None or deleted_ids is None:
+        store_issue_worklogs(key, fetch_issue_worklogs(issue_key, jira), now, replace=True)
+        logger.info(f'Fetched worklogs of {issue_key} in full, the site changed more than {limit} worklogs since the last sync.')
+        return
+
+    # the feed covers every issue, only keep the worklogs of this one
+    worklogs = [worklog for worklog in list_worklogs(jira, updated_ids) if worklog['issue_id'] == issue_id]
+
+    store_issue_worklogs(key, worklogs, until, deleted_ids=deleted_ids)
+
+    logger.info(f'Refreshed worklogs of {issue_key}: {len(worklogs)} changed, {len(deleted_ids)} deleted across the site.')
+
+def load_issue_worklogs(issue_key: str, jira: JiraClient) -> list:
+    """
+    Returns the worklogs of an issue from redis, syncing them with jira first when needed.
+
+    An issue is fetched in full the first time and whenever its copy is more than
+    `JIRA_WORKLOG_MAX_INCREMENTAL_AGE` seconds old. Otherwise it is caught up with the changes since
+    the last sync, at most once every `JIRA_WORKLOG_REFRESH_INTERVAL` seconds.
+
+    Args:
+        issue_key (str): The key of the issue.
+        jira (JiraClient): The Jira client to ask with.
+
+    Returns:
+        list: The compact worklogs, ordered by when they started.
+
+    Raises:
+        WorklogFetchError: If jira doesn't return the worklogs, e.g. because the issue doesn't exist.
+    """
+    issue_key = issue_key.upper()
+    account_id = jira.get_account_id()
+    if account_id is None:
+        raise WorklogFetchError('Jira could not be reached.')
+
+    key = copy_key(issue_key, account_id)
+    meta = r.hgetall(f'{key}_meta')
+    now = time.time()
+
+    if not meta or now - int(meta['synced_at']) / 1000 > max_incremental_age:
+        # jira counts `since` in milliseconds, start from before the fetch so nothing is missed
+        store_issue_worklogs(key, fetch_issue_worklogs(issue_key, jira), int(now * 1000), replace=True)
+    elif now - int(meta['checked_at']) > refresh_interval:
+        changes = None
+        if meta.get('issue_id') and index_is_current(int(meta['synced_at'])) and index_covers(key, meta['issue_id']):
+            changes = load_index_changes(meta['issue_id'], int(meta['synced_at']))
+
+        # the indexer may see restricted worklogs this account can't, those are checked with jira
+        if changes and not any(worklog.get('visibility') for worklog in changes[0]):
+            # the indexer already pulled the changes, read them from redis instead of jira
+            worklogs, deleted_ids, until = changes
+            store_issue_worklogs(key, worklogs, until, deleted_ids=deleted_ids)
+        elif meta.get('issue_id'):
+            refresh_issue_worklogs(issue_key, meta['issue_id'], jira, int(meta['synced_at']))
+        else:
+            # without any worklogs there's no issue ID to match changes on, but fetching it again is cheap
+            store_issue_worklogs(key, fetch_issue_worklogs(issue_key, jira), int(now * 1000), replace=True)
+
+    worklogs = [json.loads(worklog) for worklog in r.hvals(key)]
+
+    return sorted(worklogs, key=lambda worklog: worklog['started'])
+
+def index_worklogs(worklogs: list) -> None:
+    """
+    Adds worklogs to the site-wide index, or moves them if their issue changed.
+
+    Worklogs are indexed by issue with the time they were last updated as the score.
+
+    Args:
+        worklogs (list): The compact worklogs.
+
+    Returns:
+        None
+    """
+    if not worklogs:
+        return
+
+    old_worklogs = r.hmget(index_key, [worklog['id'] for worklog in worklogs])
+
+    pipe = r.pipeline()
+
+    for worklog, old_worklog in zip(worklogs, old_worklogs):
+        if old_worklog:
+            remove_from_indexes(pipe, json.loads(old_worklog))
+
+        pipe.hset(index_key, worklog['id'], json.dumps(worklog))
+        pipe.zadd(f"{index_key}:issue:{worklog['issue_id']}", {worklog['id']: worklog['updated']})
+        pipe.zrem(f"{index_key}:issue:{worklog['issue_id']}:deleted", worklog['id'])
+
+    pipe.execute()
+
+def unindex_worklogs(worklog_ids: list, deleted_at: int) -> None:
+    """
+    Removes deleted worklogs from the site-wide index and remembers when they were deleted per issue.
+
+    Args:
+        worklog_ids (list): The IDs of the deleted worklogs.
+        deleted_at (int): Epoch milliseconds the deletions are known at.
+
+    Returns:
+        None
+    """
+    if not worklog_ids:
+        return
+
+    old_worklogs = r.hmget(index_key, worklog_ids)
+
+    pipe = r.pipeline()
+
+    for worklog_id, old_worklog in zip(worklog_ids, old_worklogs):
+        if old_worklog:
+            old_worklog = json.loads(old_worklog)
+            remove_from_indexes(pipe, old_worklog)
+            pipe.zadd(f"{index_key}:issue:{old_worklog['issue_id']}:deleted", {worklog_id: deleted_at})
+        pipe.hdel(index_key, worklog_id)
+
+    pipe.execute()
+
+def remove_from_indexes(pipe, worklog: dict) -> None:
+    """
+    Queues the removal of a worklog from the index of its issue.
+
+    Args:
+        pipe: The redis pipeline to queue the commands on.
+        worklog (dict): The compact worklog as it was indexed.
+
+    Returns:
+        None
+    """
+    pipe.zrem(f"{index_key}:issue:{worklog['issue_id']}", worklog['id'])
+
+def index_is_current(since: int) -> bool:
+    """
+    Tells whether the site-wide index holds every change since a point in time and was updated recently.
+
+    Args:
+        since (int): The point in time as epoch milliseconds.
+
+    Returns:
+        bool: True if changes since that point can be read from the index.
+    """
+    cursor, checked_at = r.mget(index_cursor_key, index_checked_key)
+
+    if cursor is None or checked_at is None:
+        return False
+
+    return int(cursor) >= since and time.time() - int(checked_at) <= index_max_lag
+
+def index_covers(key: str, issue_id: str) -> bool:
+    """
+    Tells whether the site-wide index sees every change to an account's copy of an issue.
+
+    The indexer only sees the issues and worklogs its own account may browse. An issue it never
+    indexed a worklog of is taken as hidden from it, and so is any restricted worklog.
+
+    Args:
+        key (str): The key of the copy, see `copy_key`.
+        issue_id (str): The ID of the issue.
+
+    Returns:
+        bool: True if changes to the copy can be read from the index.
+    """
+    pipe = r.pipeline()
+    pipe.exists(f'{index_key}:issue:{issue_id}', f'{index_key}:issue:{issue_id}:deleted')
+    pipe.hvals(key)
+    indexed, worklogs = pipe.execute()
+
+    return indexed > 0 and not any(json.loads(worklog).get('visibility') for worklog in worklogs)
+
+def load_index_changes(issue_id: str, since: int) -> tuple:
+    """
+    Reads the worklogs of an issue that the site-wide index saw updated or deleted since a point in time.
+
+    Args:
+        issue_id (str): The ID of the issue.
+        since (int): The point in time as epoch milliseconds.
+
+    Returns:
+        tuple: The changed compact worklogs, the IDs of the deleted worklogs and the epoch milliseconds
+        the index is up to date with.
+    """
+    pipe = r.pipeline()
+    pipe.get(index_cursor_key)
+    pipe.zrangebyscore(f'{index_key}:issue:{issue_id}', since, '+inf')
+    pipe.zrangebyscore(f'{index_key}:issue:{issue_id}:deleted', since, '+inf')
+    cursor, worklog_ids, deleted_ids = pipe.execute()
+
+    worklogs = [json.loads(worklog) for worklog in r.hmget(index_key, worklog_ids) if worklog] if worklog_ids else []
+
+    return worklogs, deleted_ids, int(cursor)